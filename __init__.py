@@ -1,3 +1,4 @@
 __all__ = [
-    fname, funiq
+    'bufpool', 'exchange', 'extsort', 'fname', 'funiq', 'iotune',
+    'pathtrie', 'pipeline', 'progress', 'reclaim', 'watch'
     ]
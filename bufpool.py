@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+Buffers for reading files without making a new bytes object for
+every block. A buffer is taken from the pool, the file is read
+straight into it, the hasher is given a memoryview of the part that
+was read, and the buffer goes back for the next file:
+
+       with pool(1<<20).buffer() as buf:
+           n = read_into(fd, buf, offset)
+           hasher.update(buf[:n])
+
+The buffers are anonymous memory maps, so they start on a page
+boundary, and their lengths are rounded up to a whole page. That is
+what O_DIRECT asks for.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import contextlib
+import mmap
+import threading
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+ALIGN = mmap.PAGESIZE
+
+# Not every platform has it, and not every file system allows it.
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+
+class BufferPool:
+    """
+    Buffers of one size. There are never more of them than were in
+    use at the same time, and none is ever given back to the system.
+    """
+
+    def __init__(self, size:int, count:int=0):
+        self.size = -(-size // ALIGN) * ALIGN
+        self._free = []
+        self.allocated = 0
+        self.preallocate(count)
+
+
+    def _new(self) -> memoryview:
+        self.allocated += 1
+        return memoryview(mmap.mmap(-1, self.size))
+
+
+    def preallocate(self, count:int) -> None:
+        """
+        Make sure there are at least count buffers.
+        """
+        while self.allocated < count:
+            self._free.append(self._new())
+
+
+    @contextlib.contextmanager
+    def buffer(self) -> Iterator[memoryview]:
+        """
+        Lend out a buffer for the duration of a with statement.
+        """
+        try:
+            buf = self._free.pop()
+        except IndexError as e:
+            buf = self._new()
+
+        try:
+            yield buf
+        finally:
+            self._free.append(buf)
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+def pool(size:int) -> BufferPool:
+    """
+    returns: -- the shared pool of buffers of (at least) this size.
+    """
+    with pools_lock:
+        if size not in pools: pools[size] = BufferPool(size)
+        return pools[size]
+
+
+def read_into(fd:int, buf:memoryview, offset:int) -> int:
+    """
+    Fill buf from the file at offset, without moving the file pointer
+    and without making a copy.
+
+    A read may return fewer bytes than were asked for without being
+    at the end of the file (network file systems do, and so does a
+    signal), so we keep reading until buf is full or a read returns
+    nothing. Only that is the end of the file.
+
+    returns: -- the number of bytes read; fewer than len(buf) only
+        at the end of the file.
+    """
+    n = 0
+    while n < len(buf):
+        view = buf[n:] if n else buf
+        if hasattr(os, 'preadv'):
+            got = os.preadv(fd, [view], offset + n)
+        else:
+            os.lseek(fd, offset + n, os.SEEK_SET)
+            got = os.readv(fd, [view])
+        if not got: break
+        n += got
+    return n
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hashes that can travel. Each host writes what it knows about its
+files to an export, and the exports are joined somewhere else to
+find the files that are on more than one host. No file is moved.
+
+An export is sorted by size and then by digest, so any number of
+them can be joined by merging, one record at a time, without ever
+holding more than one group in memory:
+
+       export(state.by_size, 'hostA.fqx', host='hostA', linked=state.by_inode)
+       ...
+       for size, records in join(['hostA.fqx', 'hostB.fqx']):
+           ...
+
+The binary format is a magic line, a line of JSON describing the
+export, and then one record per file:
+
+       size        8 bytes, little endian
+       edge hash  20 bytes
+       full hash  20 bytes, all zero if it was not calculated
+       length      2 bytes, of the name that follows
+       name        UTF-8, with surrogateescape
+
+If the name of the export ends in .parquet and pyarrow is installed,
+the same columns are written as a Parquet table instead.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import collections
+import heapq
+import itertools
+import json
+import socket
+import struct
+
+# If the Apache arrow system is not installed, we will
+# simply forgive it and move on.
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError as e:
+    pyarrow = None
+
+import fname
+import pipeline
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+MAGIC = b'FUNIQX1\n'
+
+# Edge hashes can only be joined if they cover the same bytes, so
+# an export uses the same edge block on every host, whatever the 
+# file system (or the version of Python) would prefer.
+EDGE_BLOCK = 8192
+record_header = struct.Struct('<Q20s20sH')
+no_hash = bytes(20)
+
+Record = collections.namedtuple('Record', ('size', 'edge', 'full', 'path', 'host'))
+
+
+def _digest(s:str) -> Optional[bytes]:
+    """
+    The 20 bytes of a SHA1 hex digest, or None if s is one of the
+    strings Fname uses to say that the file could not be read.
+    """
+    return bytes.fromhex(s) if s and len(s) == 40 else None
+
+
+def records(files_by_size:Mapping[int, List[fname.Fname]], *,
+        host:str,
+        blocks:int=1,
+        full:bool=False,
+        workers:int=1,
+        bufsize:int=None,
+        cold_age:float=None,
+        linked:Mapping[tuple, List[fname.Fname]]=None) -> Iterator[Record]:
+    """
+    Hash every file (digests that are already known are not calculated
+    again), and yield the records in the order of an export. Files that
+    share an inode are only exported once. Files that cannot be read
+    are left out.
+
+    linked -- files with more than one link, by (device, inode), as in
+        ScanState.by_inode. One name of each inode is exported.
+    bufsize, cold_age -- how to read the files; see Fname.full_hash.
+        The edge is always EDGE_BLOCK bytes a block.
+    """
+    def hash_them(group:Tuple[int, List[fname.Fname]]) -> List[Record]:
+        size, files = group
+        found = []
+        seen = set()
+        for f in files:
+            if (f._dev, f._inode) in seen: continue
+            seen.add((f._dev, f._inode))
+            edge = _digest(f.edge_hash(blocks, None, EDGE_BLOCK, bufsize, cold_age))
+            whole = ( _digest(f.full_hash(None, bufsize, cold_age)) if full 
+                else (_digest(f._content_hash) or no_hash) )
+            f.forget()
+            if edge is None or whole is None: continue
+            found.append(Record(size, edge, whole, str(f), host))
+        return sorted(found, key=lambda r: (r.full if full else r.edge, r.path))
+
+    groups = files_by_size.items()
+    if not getattr(files_by_size, 'ascending', False): groups = sorted(groups)
+
+    # The linked files are merged in by size, so that files_by_size
+    # may be a stream.
+    if linked:
+        by_size = collections.defaultdict(list)
+        for names in linked.values():
+            by_size[len(names[0])].append(names[0])
+        merged = heapq.merge(groups, sorted(by_size.items()), key=lambda g: g[0])
+        groups = ( (size, [f for _, files in same for f in files])
+            for size, same in itertools.groupby(merged, key=lambda g: g[0]) )
+
+    for found in pipeline.in_parallel(hash_them, groups, workers):
+        yield from found
+
+
+def export(files_by_size:Mapping[int, List[fname.Fname]], path:str, *,
+        host:str=None,
+        blocks:int=1,
+        full:bool=False,
+        workers:int=1,
+        bufsize:int=None,
+        cold_age:float=None,
+        linked:Mapping[tuple, List[fname.Fname]]=None) -> int:
+    """
+    Write an export of the files, sorted by size and digest. The digest
+    is the full hash if full is True, otherwise the edge hash; what the
+    edge hash covers is recorded, because only exports with the same
+    edge can be joined on it.
+
+    returns: -- the number of records written.
+    """
+    host = host if host is not None else socket.gethostname()
+    about = {'host':host,
+        'full':full,
+        'edge_bytes':blocks * EDGE_BLOCK,
+        'version':1}
+    rows = records(files_by_size, host=host, blocks=blocks, full=full, workers=workers,
+        bufsize=bufsize, cold_age=cold_age, linked=linked)
+
+    if path.endswith('.parquet'):
+        if pyarrow is None:
+            raise ValueError("Parquet exports need pyarrow.")
+        rows = list(rows)
+        table = pyarrow.table({
+            'size':[r.size for r in rows],
+            'edge':[r.edge for r in rows],
+            'full':[r.full for r in rows],
+            'path':[r.path for r in rows],
+            'host':[r.host for r in rows]})
+        table = table.replace_schema_metadata({b'funiq':json.dumps(about).encode('utf-8')})
+        pyarrow.parquet.write_table(table, path)
+        return len(rows)
+
+    n = 0
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(json.dumps(about).encode('utf-8') + b'\n')
+        for r in rows:
+            name = r.path.encode('utf-8', 'surrogateescape')
+            f.write(record_header.pack(r.size, r.edge, r.full, len(name)))
+            f.write(name)
+            n += 1
+    return n
+
+
+def about(path:str) -> dict:
+    """
+    returns: -- the description at the top of an export.
+    """
+    if path.endswith('.parquet'):
+        if pyarrow is None:
+            raise ValueError("Parquet exports need pyarrow.")
+        metadata = pyarrow.parquet.read_schema(path).metadata or {}
+        return json.loads(metadata[b'funiq'])
+
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError(f"{path} is not a funiq export.")
+        return json.loads(f.readline())
+
+
+def read(path:str) -> Iterator[Record]:
+    """
+    Yield the records of an export in the order they were written.
+    """
+    if path.endswith('.parquet'):
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from (Record(**row) for row in batch.to_pylist())
+        return
+
+    with open(path, 'rb') as f:
+        f.readline()
+        host = json.loads(f.readline())['host']
+        while header := f.read(record_header.size):
+            size, edge, full, n = record_header.unpack(header)
+            name = f.read(n).decode('utf-8', 'surrogateescape')
+            yield Record(size, edge, full, name, host)
+
+
+def join(paths:Iterable[str], within:bool=False) -> Iterator[Tuple[int, List[Record]]]:
+    """
+    Merge the exports, and yield (size, [Record, ...]) for each group
+    of files with the same size and digest. Unless within is True,
+    only the groups with files on more than one host are yielded.
+
+    All of the exports must have been made the same way: all with
+    full hashes, or all with edge hashes of the same length.
+    """
+    paths = list(paths)
+    kinds = { (_['full'], None if _['full'] else _['edge_bytes']) for _ in map(about, paths) }
+    if len(kinds) > 1:
+        raise ValueError("The exports were not made the same way, and cannot be joined. "
+            "Export with full hashes (defcon < 4) or with the same edge on every host.")
+    full = kinds.pop()[0] if kinds else True
+
+    key = (lambda r: (r.size, r.full)) if full else (lambda r: (r.size, r.edge))
+    merged = heapq.merge(*(read(_) for _ in paths), key=key)
+    for (size, digest), group in itertools.groupby(merged, key=key):
+        group = list(group)
+        if len(group) < 2: continue
+        if within or len({r.host for r in group}) > 1:
+            yield size, group
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Grouping that does not have to fit in memory. Items are added with
+a key; when there are more of them than the memory budget allows,
+they are sorted and written to a temporary file (a "run"). Asking
+for the groups merges the runs, and whatever is still in memory,
+so that each group comes out once, in key order:
+
+       g = ExternalGrouper('/local/scratch', memory_budget=1<<30)
+       for f in files: g.add(len(f), f)
+       for size, files in g.items():
+           ...
+
+The items are pickled. Objects that should not be written into every
+record, such as a pathtrie.DirTrie shared by millions of Fname
+objects, can be named as shared; the records then refer to them, and
+they are still in memory when the records are read back.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import heapq
+import io
+import itertools
+import pickle
+import re
+import struct
+import tempfile
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+record_length = struct.Struct('<I')
+
+size_units = {'':1, 'K':1<<10, 'M':1<<20, 'G':1<<30, 'T':1<<40}
+
+def parse_size(s:str) -> int:
+    """
+    '512M' =>> 536870912. A number with no suffix is bytes.
+    """
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', str(s), re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"{s} is not a size.")
+    return int(float(m.group(1)) * size_units[m.group(2).upper()])
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, f:io.IOBase, shared:Dict[int, int]):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = shared
+
+    def persistent_id(self, obj:object) -> Optional[int]:
+        return self.shared.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f:io.IOBase, shared:List[object]):
+        super().__init__(f)
+        self.shared = shared
+
+    def persistent_load(self, pid:int) -> object:
+        return self.shared[pid]
+
+
+class ExternalGrouper:
+    """
+    A dict of lists that spills to disc. Keys must be sortable and
+    picklable, and the items picklable.
+    """
+
+    def __init__(self, spill_dir:str=None, *,
+            memory_budget:int=1<<30,
+            item_bytes:int=512,
+            reverse:bool=False,
+            shared:Iterable[object]=()):
+        """
+        spill_dir -- where the runs go; the default is the system's
+            temporary directory. The files are deleted as soon as they
+            are closed.
+        memory_budget -- bytes that the items in memory may take up.
+        item_bytes -- about how big one item is, with its key.
+        reverse -- give the groups in descending order of key.
+        shared -- objects that are referred to, rather than written.
+        """
+        self.spill_dir = spill_dir
+        self.limit = max(memory_budget // item_bytes, 1)
+        self.reverse = reverse
+        # Iterated in ascending order, so it need not be sorted again.
+        self.ascending = not reverse
+        self.shared = list(shared)
+        self.shared_ids = { id(o):i for i, o in enumerate(self.shared) }
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+        self.held = 0
+
+
+    def __len__(self) -> int:
+        """
+        returns: -- the number of items (not keys).
+        """
+        return self.count
+
+
+    def add(self, key:Any, item:Any, weight:int=1) -> None:
+        """
+        weight -- how many items of item_bytes this one counts as;
+            e.g., a group of files counts as the number of files.
+        """
+        self.buffer.append((key, item))
+        self.count += 1
+        self.held += weight
+        if self.held >= self.limit: self.spill()
+
+
+    def _sort(self) -> None:
+        self.buffer.sort(key=lambda kv: kv[0], reverse=self.reverse)
+
+
+    def spill(self) -> None:
+        """
+        Write what is in memory as one sorted run.
+        """
+        if not self.buffer: return
+        self._sort()
+        run = tempfile.TemporaryFile(dir=self.spill_dir, buffering=1<<20)
+        for kv in self.buffer:
+            data = io.BytesIO()
+            _Pickler(data, self.shared_ids).dump(kv)
+            run.write(record_length.pack(data.tell()))
+            run.write(data.getbuffer())
+        run.flush()
+        self.runs.append(run)
+        self.buffer = []
+        self.held = 0
+
+
+    def _read(self, run:io.IOBase) -> Iterator[Tuple[Any, Any]]:
+        run.seek(0)
+        while header := run.read(record_length.size):
+            n, = record_length.unpack(header)
+            yield _Unpickler(io.BytesIO(run.read(n)), self.shared).load()
+
+
+    def items(self) -> Iterator[Tuple[Any, List[Any]]]:
+        """
+        Yield (key, [items]) for each key, in order. Only one group
+        is in memory at a time, beyond what has not been spilled.
+        """
+        self._sort()
+        streams = [ self._read(run) for run in self.runs ] + [ iter(self.buffer) ]
+        merged = heapq.merge(*streams, key=lambda kv: kv[0], reverse=self.reverse)
+        for key, group in itertools.groupby(merged, key=lambda kv: kv[0]):
+            yield key, [ item for _, item in group ]
+
+
+    def values(self) -> Iterator[List[Any]]:
+        return (v for _, v in self.items())
+
+
+    def clear(self) -> None:
+        for run in self.runs: run.close()
+        self.runs = []
+        self.buffer = []
+        self.count = 0
+        self.held = 0
@@ -19,15 +19,22 @@ This class supports all the comparison operators ( ==, !=, <, <=,
 """
 
 
+import collections
+import errno
 import fcntl
-from   functools import total_ordering
+from   functools import lru_cache, total_ordering
 import hashlib
 import io
 import os
+import stat
+import sys
+import time
 import typing
 from   typing import *
 from   urllib.parse import urlparse
 
+import bufpool
+
 # Credits
 __author__ = 'George Flanagin'
 __copyright__ = 'Copyright 2015, University of Richmond'
@@ -38,6 +45,34 @@ __email__ = 'gflanagin@richmond.edu'
 __status__ = 'Prototype'
 __license__ = 'MIT'
 
+@lru_cache(maxsize=4)
+def _zeros(n:int) -> memoryview:
+    return memoryview(bytes(n))
+
+
+@lru_cache(maxsize=256)
+def zero_digest(size:int) -> str:
+    """
+    returns: -- the hash of size zero bytes, i.e., of a file that is
+        nothing but holes. Trees of checkpoints have many of them, 
+        and most are the same few sizes.
+    """
+    hasher = hashlib.sha1()
+    z = _zeros(1<<20)
+    while size > 0:
+        hasher.update(z[:min(size, len(z))])
+        size -= len(z)
+    return hasher.hexdigest()
+
+
+class OutOfTime(Exception):
+    """
+    Hashing stopped at a deadline. This is not an OSError, so it is
+    not mistaken for a file that cannot be read.
+    """
+    pass
+
+
 """
 This is Guido's hack to allow forward references for types not yet
 defined.
@@ -60,6 +95,8 @@ class Fname:
     """
 
     BUFSIZE = io.DEFAULT_BUFFER_SIZE
+    EDGE_BLOCK = io.DEFAULT_BUFFER_SIZE
+    COLD_AGE = None
     __slots__ = { 
         '_me' : 'The name as it appears in the constructor',   # 0
         '_is_URI' : 'True or False based on containing a "scheme"',  # 1 
@@ -75,11 +112,21 @@ class Fname:
         '_content_hash' : 'hexdigit string representing the hash of the contents at last reading', # 11
         '_edge_hash' : 'hash of the first and last disc page of the file.', # 12 
         '_lock_handle' : 'an entry in the logical unit table.', # 13
-        '_DoB' : 'Approximate age of the file in days.' # 14
+        '_DoB' : 'Approximate age of the file in days.', # 14
+        '_exists' : 'existence as of the stat in from_stat, or None to look every time.', # 15
+        '_edge_bytes' : 'how many bytes went into the _edge_hash', # 16
+        '_hasher' : 'running hash of the contents, if they have been partly read.', # 17
+        '_hashed_to' : 'how far into the file the running hash has read.', # 18
+        '_dev' : 'the device that holds the inode', # 19
+        '_uid' : 'owner of the file', # 20
+        '_gid' : 'group of the file', # 21
+        '_trie' : 'where the directory names are kept, if not in _fqn', # 22
+        '_dir_id' : 'the number of the directory in _trie', # 23
+        '_blocks' : 'st_blocks: 512 byte blocks allocated, or -1 if unknown' # 24
         }
 
-    __values__ = ( None, False, '', '', '', '', '', '', -1, 0, None, '', '', None, 0.0 )
-    #               0      1    2   3   4   5   6   7   8   9    10  11  12   13    14
+    __values__ = ( None, False, '', None, None, None, None, None, -1, 0, None, '', '', None, 0.0, None, 0, None, 0, 0, -1, -1, None, -1, -1 )
+    #               0      1    2   3     4     5     6     7     8   9    10  11  12   13    14    15  16  17   18 19  20  21  22    23  24
 
     __defaults__ = dict(zip(__slots__.keys(), __values__))
 
@@ -107,14 +154,15 @@ class Fname:
         else:
             self._fqn = os.path.abspath(os.path.expandvars(os.path.expanduser(s)))
 
-        self._dir, self._fname = os.path.split(self._fqn)
-        self._fname_only, self._ext = os.path.splitext(self._fname)
-        self._all_but_ext = self._dir + os.path.sep + self._fname_only
         try:
             result = os.stat(self._fqn)
             self._inode = result.st_ino
+            self._dev = result.st_dev
+            self._uid = result.st_uid
+            self._gid = result.st_gid
             self._len = result.st_size
             self._nlink = result.st_nlink
+            self._blocks = getattr(result, 'st_blocks', -1)
             self._DoB = result.st_mtime
         except Exception as e:
             pass
@@ -127,8 +175,12 @@ class Fname:
         Note: this allows one to build the Fname object at a time when "if"
         would return False, open the file for write, test again, and "if"
         will then return True.
+
+        Objects made with from_stat answer from the stat they were 
+        given instead.
         """
-        return os.path.isfile(self._fqn)
+        if self._exists is not None: return self._exists
+        return os.path.isfile(self.fqn)
 
 
     def __call__(self, new_content:str=None) -> Union[bytes, Fname]:
@@ -157,6 +209,9 @@ class Fname:
         else:
             with open(str(self), 'ab') as f:
                 f.write(new_content.encode('utf-8'))
+
+        # Whatever we knew about the file is no longer true.
+        if new_content: self._exists = None
             
         return content if new_content is None else self
         
@@ -180,11 +235,11 @@ class Fname:
         str(f) =>> '/home/data/import/big.file.dat'
         """
 
-        return self._fqn
+        return self.fqn
 
 
     def __format__(self, x) -> str:
-        return self._fqn
+        return self.fqn
 
 
     def __eq__(self, other) -> bool:
@@ -226,16 +281,90 @@ class Fname:
         if not self or not other: return False
         if len(self) != len(other): return False
 
-        if not self._edge_hash: self.edge_hash()
-        if not other._edge_hash: other.edge_hash()
-        if self._edge_hash != other._edge_hash: return False
+        # Nothing need be read if both are already known.
+        if self._content_hash and other._content_hash:
+            return self._content_hash == other._content_hash
 
-        # Gotta look at the contents. See if our hash is known.
-        if not self._content_hash: self()
-            
-        # Make sure the other object's hash is known.
-        if not len(other._content_hash): other()
-        return self._content_hash == other._content_hash
+        # A file that cannot be read is not the same as anything.
+        edge = self.edge_hash()
+        if edge is None or edge != other.edge_hash(): return False
+
+        # Gotta look at the contents. The hashes are kept, so each
+        # file is only read once no matter how often it is compared.
+        digest = self.hash
+        return digest is not None and digest == other.hash
+
+
+    @classmethod
+    def from_stat(cls, s:str, st:os.stat_result, 
+            trie:object=None, dir_id:int=-1) -> Fname:
+        """
+        The fast way to make an Fname when the caller has already 
+        called stat. The name must already be fully qualified, as
+        it is when it comes from os.walk or os.scandir; no expansion
+        is done, and the file is not stat-ed again. The answer to 
+        "if f" is taken from the stat, and is not looked up again.
+
+        trie, dir_id -- if given, s is only the name of the file, and
+            the name of its directory is trie.path(dir_id). The fully
+            qualified name is put together each time it is needed,
+            rather than kept. See pathtrie.DirTrie.
+        """
+        self = cls.__new__(cls)
+        for k,v in Fname.__defaults__.items():
+            setattr(self, k, v)
+
+        self._me = s
+        if trie is None:
+            self._fqn = s
+        else:
+            self._fqn = None
+            self._fname = s
+            self._trie = trie
+            self._dir_id = dir_id
+        self._inode = st.st_ino
+        self._dev = st.st_dev
+        self._uid = st.st_uid
+        self._gid = st.st_gid
+        self._len = st.st_size
+        self._nlink = st.st_nlink
+        self._blocks = getattr(st, 'st_blocks', -1)
+        self._DoB = st.st_mtime
+        self._exists = stat.S_ISREG(st.st_mode)
+        return self
+
+
+    # These belong to the process that has them, and are not pickled.
+    __transient__ = ('_hasher', '_hashed_to', '_lock_handle')
+
+    def __reduce__(self) -> tuple:
+        """
+        Pickle the values of the slots, in order, without their names;
+        a spilled Fname is written many millions of times. A hash that
+        is only partly done, or a lock, starts over in the copy.
+        """
+        return (Fname._unpickle, tuple(
+            Fname.__defaults__[k] if k in Fname.__transient__ else getattr(self, k)
+                for k in Fname.__slots__))
+
+
+    @staticmethod
+    def _unpickle(*values) -> Fname:
+        self = Fname.__new__(Fname)
+        for k, v in zip(Fname.__slots__, values):
+            setattr(self, k, v)
+        return self
+
+
+    def _split(self) -> None:
+        """
+        Take the name apart. This is only done the first time one 
+        of the parts is wanted because most Fname objects are only 
+        ever used for their fully qualified name.
+        """
+        self._dir, self._fname = os.path.split(self.fqn)
+        self._fname_only, self._ext = os.path.splitext(self._fname)
+        self._all_but_ext = self._dir + os.path.sep + self._fname_only
 
 
     @property
@@ -254,6 +383,7 @@ class Fname:
         f.all_but_ext() =>> '/home/data/import/big.file' ... note lack of trailing dot
         """
 
+        if self._all_but_ext is None: self._split()
         return self._all_but_ext
 
 
@@ -316,6 +446,7 @@ class Fname:
             trailing solidus in the default behavior.
         """
 
+        if self._dir is None: self._split()
         if terminated:
             return self._dir + os.sep
         else:
@@ -341,6 +472,7 @@ class Fname:
         f.ext() =>> 'dat'
         """
 
+        if self._ext is None: self._split()
         return self._ext
 
 
@@ -351,6 +483,7 @@ class Fname:
         f.fname() =>> 'big.file.dat'
         """
 
+        if self._fname is None: self._split()
         return self._fname
 
 
@@ -361,6 +494,7 @@ class Fname:
         f.fname_only() =>> 'big.file'
         """
 
+        if self._fname_only is None: self._split()
         return self._fname_only
 
 
@@ -372,50 +506,315 @@ class Fname:
         NOTE: this is the same result as you get with str(f)
         """
 
+        if self._fqn is None: 
+            d = self._trie.path(self._dir_id)
+            # Of the directories, only the root ends with a separator.
+            return (d if d == os.sep else d + os.sep) + self._fname
         return self._fqn
 
 
-    def edge_hash(self, num_blocks:int=1) -> str:
-        hasher = hashlib.sha1()
+    def _hash_through(self, offset:int, deadline:float=None, 
+            bufsize:int=None, cold_age:float=None) -> bool:
+        """
+        Bring the running hash of the contents up to offset, or to
+        the end of the file if that comes first. The running hash is
+        kept between calls, so that the full hash picks up where the
+        edge hash left off, and no part of the file is read twice.
+
+        The file is read into a buffer from a pool that is shared by
+        all Fname objects, and the hasher is handed a view of it, so
+        no memory is allocated for each block. Files that have not 
+        been modified in cold_age seconds are read with O_DIRECT, so
+        that reading them does not push other people's data out of
+        the page cache.
+
+        The holes in sparse files are not read; the hasher is given
+        zeros for them, and a file that is all holes is not hashed
+        at all.
+
+        deadline -- a time.time() at which to stop, between blocks, by
+            raising OutOfTime. What has been hashed is kept, and a 
+            later call carries on from there.
+        bufsize, cold_age -- how much to read at a time, and the age in
+            seconds beyond which to use O_DIRECT. They are given by each
+            scan (see iotune.IOPlan), so that two scans in one process 
+            can read differently; Fname.BUFSIZE and Fname.COLD_AGE are
+            only the defaults.
+
+        returns: -- False if the file could not be read.
+        """
+        if self._content_hash: return True
+
+        # Asked for less than we have already read; start over.
+        if self._hasher is None or self._hashed_to > offset:
+            self._hasher = hashlib.sha1()
+            self._hashed_to = 0
+
+        bufsize = bufsize if bufsize else Fname.BUFSIZE
+        cold_age = cold_age if cold_age is not None else Fname.COLD_AGE
+        direct = ( bufpool.O_DIRECT and cold_age is not None and 
+            time.time() - self._DoB > cold_age )
+
+        sparse = self.sparse and hasattr(os, 'SEEK_DATA')
+
+        fd = None
         try:
-            with open(str(self), 'rb') as f:
-                for i in range(num_blocks):
-                    hasher.update(block := f.read(io.DEFAULT_BUFFER_SIZE))
-                    if (read_it_all := len(block) < io.DEFAULT_BUFFER_SIZE): 
+            fd = self._open(direct)
+            if sparse and offset >= self._len and self._extent(fd, 0) == (False, self._len):
+                self._content_hash = zero_digest(self._len)
+                self._hasher = None
+                return True
+
+            with bufpool.pool(bufsize).buffer() as buf:
+                while self._hashed_to < offset:
+                    if deadline is not None and time.time() >= deadline:
+                        raise OutOfTime(f"Ran out of time hashing {self}")
+
+                    want = min(len(buf), offset - self._hashed_to)
+                    if sparse:
+                        in_data, end = self._extent(fd, self._hashed_to)
+                        if not in_data:
+                            self._hash_zeros(min(end, offset) - self._hashed_to, bufsize)
+                            continue
+                        want = min(want, end - self._hashed_to)
+                    view = buf if want == len(buf) else buf[:want]
+
+                    # O_DIRECT wants aligned offsets and lengths, and
+                    # some file systems do not want it at all. If opening
+                    # the file again fails, the finally must not close a 
+                    # number that another thread may have been given.
+                    if direct and (self._hashed_to % bufpool.ALIGN or want % bufpool.ALIGN):
+                        os.close(fd)
+                        fd = None
+                        fd, direct = self._open(False), False
+                    try:
+                        n = bufpool.read_into(fd, view, self._hashed_to)
+                    except OSError as e:
+                        if not direct or e.errno != errno.EINVAL: raise
+                        os.close(fd)
+                        fd = None
+                        fd, direct = self._open(False), False
+                        n = bufpool.read_into(fd, view, self._hashed_to)
+
+                    self._hasher.update(view if n == want else view[:n])
+                    self._hashed_to += n
+                    # read_into only comes up short at the end of the file.
+                    if n < want: 
+                        self._content_hash = self._hasher.hexdigest()
+                        self._hasher = None
                         break
 
+        except OutOfTime as e:
+            raise
+
         except Exception as e:
-            return '00000000000000'
+            self._hasher = None
+            return False
+
+        finally:
+            if fd is not None: os.close(fd)
+
+        return True
+
+
+    def _extent(self, fd:int, offset:int) -> Tuple[bool, int]:
+        """
+        returns: -- (True, end) if offset is in the data of the file,
+            or (False, end) if it is in a hole, where end is the offset
+            at which that data or hole stops. File systems that do not 
+            know about holes say that the whole file is data.
+        """
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO and offset < self._len:
+                return False, self._len
+            return True, sys.maxsize
+
+        if data > offset: return False, data
+        try:
+            return True, os.lseek(fd, offset, os.SEEK_HOLE)
+        except OSError as e:
+            return True, sys.maxsize
+
+
+    def _hash_zeros(self, n:int, bufsize:int) -> None:
+        """
+        Hash n bytes of a hole, without reading them.
+        """
+        z = _zeros(bufsize)
+        self._hashed_to += n
+        while n > 0:
+            self._hasher.update(z[:min(n, len(z))])
+            n -= len(z)
+
+
+    def _open(self, direct:bool=False) -> int:
+        """
+        returns: -- a file descriptor for reading, with O_DIRECT if
+            asked and if the file system allows it.
+        """
+        if direct:
+            try:
+                return os.open(str(self), os.O_RDONLY | bufpool.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL: raise
+        return os.open(str(self), os.O_RDONLY)
+
+
+    def edge_hash(self, num_blocks:int=1, deadline:float=None, 
+            edge_block:int=None, bufsize:int=None, cold_age:float=None) -> Optional[str]:
+        """
+        Return the hash of the first num_blocks blocks of edge_block
+        bytes (by default, Fname.EDGE_BLOCK) of the file. If that turns
+        out to be the whole file, it is also the content hash. If the
+        file cannot be read, return None; such a file is not the same
+        as any other. See _hash_through for the rest.
+
+        The digest is kept for the number of bytes it covers, so the
+        edges of two files only match if they were hashed over the
+        same bytes.
+        """
+        edge = num_blocks * (edge_block if edge_block else Fname.EDGE_BLOCK)
+        if self._edge_hash and self._edge_bytes == edge:
+            return self._edge_hash
+
+        if self._content_hash and self._len > edge:
+            return self._rehash_edge(edge, deadline, bufsize, cold_age)
 
-        self._edge_hash = hasher.hexdigest()
-        if read_it_all: self._content_hash = self._edge_hash
+        if not self._hash_through(edge, deadline, bufsize, cold_age):
+            return None
+
+        self._edge_bytes = edge
+        self._edge_hash = ( self._content_hash if self._content_hash else 
+            self._hasher.copy().hexdigest() )
+        return self._edge_hash
+
+
+    def _rehash_edge(self, edge:int, deadline:float=None, 
+            bufsize:int=None, cold_age:float=None) -> Optional[str]:
+        """
+        The whole file was hashed before its edge was asked for, and
+        the digest of the whole file is not the digest of its edge, 
+        which is what the file's siblings will have. Read the edge 
+        again; the digest of the whole file is kept.
+        """
+        content, self._content_hash = self._content_hash, None
+        try:
+            readable = self._hash_through(edge, deadline, bufsize, cold_age)
+        finally:
+            self._content_hash = content
+
+        # A file that got shorter has no hasher left; it is not the
+        # file that was hashed.
+        if not readable or self._hasher is None:
+            self._hasher = None
+            return None
+
+        self._edge_bytes = edge
+        self._edge_hash = self._hasher.hexdigest()
+        self._hasher = None
         return self._edge_hash
 
 
+    def forget(self) -> None:
+        """
+        Let go of the partially calculated hash of a file that will 
+        not be hashed any further. The digests are kept.
+        """
+        self._hasher = None
+
+
     @property
-    def hash(self) -> str:
+    def hash(self) -> Optional[str]:
         """
         Return the hash if it has already been calculated, otherwise
-        calculate it and then return it. 
+        calculate it and then return it. If the file cannot be read, 
+        return None; such a file is not the same as any other.
         """
-        if self._content_hash: 
-            return self._content_hash
+        return self.full_hash()
 
-        hasher = hashlib.sha1()
 
-        try:
-            with open(str(self), 'rb') as f:
-                while True:
-                    hasher.update(segment := f.read(Fname.BUFSIZE))
-                    if len(segment) < Fname.BUFSIZE: break
-        except:
-            self._content_hash = '0000000000000000'
-        else:
-            self._content_hash = hasher.hexdigest()
+    def full_hash(self, deadline:float=None, 
+            bufsize:int=None, cold_age:float=None) -> Optional[str]:
+        """
+        The hash property, with a deadline and a way of reading; see 
+        _hash_through.
+        """
+        if not self._hash_through(sys.maxsize, deadline, bufsize, cold_age):
+            return None
 
         return self._content_hash
 
 
+    @staticmethod
+    def partition_identical(files:Iterable[Fname], num_blocks:int=1) -> List[List[Fname]]:
+        """
+        Sort the files into classes with identical contents. The sizes
+        are compared first, then the hashes of the edges, and the whole
+        contents only where the edges agree. Each file is read at 
+        most once, and digests that are already known are not 
+        calculated again.
+
+        returns: -- a list of lists of Fname objects. Every file is in
+            exactly one of them, and files that are not there, cannot
+            be read, or are not like any other, are each in a list by
+            themselves.
+        """
+        classes = []
+        by_size = collections.defaultdict(list)
+        for f in files:
+            if f: by_size[len(f)].append(f)
+            else: classes.append([f])
+
+        for group in by_size.values():
+            if len(group) == 1:
+                classes.append(group)
+                continue
+
+            by_edge = collections.defaultdict(list)
+            for f in group:
+                edge = f.edge_hash(num_blocks)
+                if edge is None: classes.append([f])
+                else: by_edge[edge].append(f)
+
+            for edge_group in by_edge.values():
+                if len(edge_group) == 1:
+                    edge_group[0].forget()
+                    classes.append(edge_group)
+                    continue
+
+                by_hash = collections.defaultdict(list)
+                for f in edge_group:
+                    digest = f.hash
+                    if digest is None: classes.append([f])
+                    else: by_hash[digest].append(f)
+                classes.extend(by_hash.values())
+
+        return classes
+
+
+    @property
+    def allocated(self) -> int:
+        """
+        returns: -- the bytes the file takes up on disc, as far as the
+            stat knows; for all but sparse files, its length. This is
+            what removing a copy of it would free.
+        """
+        return self._blocks * 512 if self.sparse else self._len
+
+
+    @property
+    def sparse(self) -> bool:
+        """
+        returns: -- True if fewer bytes are allocated to the file than
+            its length. Usually some of it is holes, which read as zeros,
+            but a file that the file system has compressed looks the 
+            same; see _extent() for where the holes really are.
+        """
+        return 0 <= self._blocks * 512 < self._len
+
+
     @property
     def is_URI(self) -> bool:
         """ 
@@ -435,6 +834,8 @@ class Fname:
             fcntl.flock(self._lock_handle, mode)
         except Exception as e:
             print(f"{e}")
+            if self._lock_handle is not None: os.close(self._lock_handle)
+            self._lock_handle = None
             return False
         else:
             return True
@@ -450,6 +851,14 @@ class Fname:
         return self._lock_handle is not None
 
 
+    @property
+    def owner(self) -> Tuple[int, int]:
+        """
+        returns: -- (uid, gid) as of the stat, or (-1, -1) if there was none.
+        """
+        return self._uid, self._gid
+
+
     def show(self) -> None:
         """ 
             this is a diagnostic function only. Probably not used
@@ -482,6 +891,7 @@ class Fname:
         """
         try:
             fcntl.flock(self._lock_handle, fcntl.LOCK_UN)
+            os.close(self._lock_handle)
         except Exception as e:
             print(str(e))
             return False
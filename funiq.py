@@ -23,9 +23,11 @@ import typing
 from   typing import *
 
 import argparse
-import collections
-import datetime
+import csv
+import itertools
 import resource
+import socket
+import tempfile
 import time
 import textwrap
 
@@ -55,30 +57,16 @@ except ImportError as e:
     sys.stderr.write("You must install pandas to run this program.\n")
     sys.exit(os.EX_SOFTWARE)
 
+import exchange
+import extsort
 import fname
-
-#####################################
-# Some Global data structures.      #
-#####################################
-
-####
-# To look for pseudo duplicates that are actually hard links.
-####
-by_inode    = collections.defaultdict(list)
-
-####
-# To look for files that are the same size
-####
-by_size     = collections.defaultdict(list)
-
-####
-# For files that are the same size, we check the hashes.
-####
-by_edge_hash = collections.defaultdict(list)
-by_hash     = collections.defaultdict(list)
-
-hardlinks   = collections.defaultdict(list)
-
+import iotune
+import pathtrie
+import pipeline
+import progress
+import reclaim
+import watch
+from   pipeline import byte_scale, byte_symbols, expandall
 
 funiq_help = """
     For the most up to date help, see:
@@ -86,16 +74,28 @@ funiq_help = """
         https://github.com/georgeflanagin/funiq/blob/v2/README.md
 
 
-    Unless you are running --quiet, the program will display
-        a period for every 1000 files that are "stat-ed" when the
-        directory is being browsed.
+    Unless you are running --quiet, the program will report its
+        progress every --progress seconds: how many files have been
+        "stat-ed" while the directory is being browsed, and then how
+        many files and bytes have been hashed, how fast, how many
+        groups of files are left, and about when they will be done.
 
-    Hashing is shown with a # for every 1000 files that are 
-        hashed. 
+    Only the data in sparse files is read; their holes are hashed as
+        zeros. A file counts as sparse when fewer bytes are allocated to
+        it than its length, which is also true of files that a file
+        system such as ZFS or Btrfs has compressed. Those are read in
+        full, and their unallocated bytes are only an upper bound on
+        the holes.
 
     --batch :: The program never prompts the user for any confirmations
         and assumes the user understands the operation.
 
+    --cold-days :: Files that have not been modified in this many days
+        are read with O_DIRECT, so that hashing an archive does not push
+        everyone else's data out of the page cache on a shared node. On
+        file systems that do not allow O_DIRECT, the files are read the
+        usual way. By default, nothing is read with O_DIRECT.
+
     --defcon :: by default, this value is 5. Files that are the same
         size are stochastically examined for differences. The level will
         compare the first page (DEFAULT_BUFFER_SIZE bytes) of the files. 
@@ -104,11 +104,18 @@ funiq_help = """
         hash of the contents in a subprocess. Level 1 runs the process
         in exclusive access mode as root, if the call to setuid succeeds. 
 
-    --dir :: The top level directory to check if not the $PWD. The idea
-        is that every file system has a mount point, and this program
-        is only designed to check a single file system. Thus, if a
-        file is duplicated on a different file system, it is probably 
-        required there.
+    --dir :: The top level directory to check if not the $PWD. This
+        parameter can be used multiple times to look for copies across
+        several directories, such as a project tier and a scratch tier.
+        Directories on different devices are scanned at the same time,
+        one thread for each device, and the files are compared across
+        all of them. A directory inside another one is only scanned
+        once.
+
+    --dry-run :: With --reclaim, nothing is changed and no more files
+        are read. The program reports how many bytes would be freed, and
+        how many bytes would still have to be read to verify groups that
+        have only been edge hashed.
 
     --exclude, -x :: This parameter can be used multiple times. Remember
         that hidden files will not require an explicit exclusion in 
@@ -119,49 +126,138 @@ funiq_help = """
         begins with "private" will be excluded.
 
         Given that one may want to run this program as root, funiq 
-        will always ignore files that are owned by root, as well as
-        files in the top level directories like /dev, /proc, /mnt, 
-        /sys, /boot, and /var.
+        will ignore files that are owned by root (unless you say
+        --include-root-files), as well as files in the top level 
+        directories like /dev, /proc, /mnt, /sys, /boot, and /var.
+
+    --export :: The name of a file to hold the size, the edge and full 
+        hashes, and the name of every file that was considered, whether 
+        or not it has a duplicate here, along with the --host name. Every
+        file is hashed for this. The export is sorted by size and hash. 
+        The edge block is always 8192 bytes in a run with --export, so
+        that the exports of hosts with different file systems can be
+        joined. If the name ends in .parquet and pyarrow is installed,
+        it is a Parquet table, otherwise it is funiq's own compact format.
+        Nothing is exported by a run that ran out of time or was 
+        interrupted.
 
     --fmt, --format :: One of csv, pickle, pandas, feather, or stata.
         The default is csv in the form of a fact table. The file will
         be given an extension with the same name unless an extension
-        is given in the --output directive.
+        is given in the --output directive. Each row has the size, the
+        name, the date, and the owner of a duplicated file. Two more 
+        tables are written next to it, .owners and .dirs (for example,
+        duplicatefiles.owners.csv), with the number of duplicated files 
+        and bytes for each owner and for each directory just below 
+        --dir. The oldest file in a group is taken to be the original, 
+        and is not counted. The bytes are those on disc, so they add up
+        to what --reclaim would free.
 
     --follow-links :: If present, symbolic links will be resolved. The 
         default is to treat links and links because the program does
         not check to see if a file has already been stat-ed.
 
+    --host :: The name to use for this host in an --export. The default
+        is the hostname.
+
+    --include-root-files :: Files owned by root are normally ignored.
+
     --include-hidden :: This switch is generally off, and hidden files
         will be excluded. They are often part of a git repo, or a part
         of some program's cache. Why bother? 
 
+    --io-tune :: auto, table, or off. The default, auto, looks up the
+        type of the file system and its preferred block size, then times
+        a few reads of the largest candidate files to choose the size of
+        the edge block, the size of the reads for full hashes, and the
+        number of files read at once. "table" skips the timings, and
+        "off" reads one file at a time with the default buffer size.
+        When the --dir roots are on more than one file system, each is
+        looked at, and the largest sizes and the most readers are used
+        for all of them. The choices are printed with the other
+        statistics.
+
+    --join :: One or more exports from different hosts. Nothing is
+        scanned; the exports are merged in sorted order, without loading
+        them into memory, and the report has the files that have copies
+        on more than one host. The exports must all have full hashes 
+        (defcon < 4), or all have edge hashes over the same number of 
+        bytes.
+
     --limit :: if set, the program will stop scanning after this many files
         are stat-ed. This switch facilitates testing.
 
+    --one-file-system :: Do not descend into file systems that are
+        mounted below a --dir, e.g., an NFS mount in the middle of a
+        local tree.
+
+    --memory-budget :: The most memory, e.g., 512M or 4G, to use for the 
+        lists of files while they are grouped by size and sorted by the
+        space they could free. Beyond that, they are sorted in pieces
+        that are written to temporary files, and the pieces are merged,
+        so the number of files is limited by the disc rather than the
+        memory. Implies sorting on disc in --spill-dir; the default
+        budget with --spill-dir alone is 1G.
+
     --nice :: defaults to 20, which is roughly the equivalent of Canadian.
         Values range from 0 to 20, where 0 is rude.
 
     --output, -o :: name of the file to contain the output. If no extension,
         it will be imputed from the --format spec.
 
+    --progress :: Seconds between the reports of progress. The default
+        is 10, or 1 with --verbose; 0 turns them off.
+
     --quiet :: no screen output except for errors.
 
+    --reclaim :: hardlink or reflink. After the duplicates are found,
+        keep the oldest file of each group and replace the others with
+        hard links to it, or with reflinks (copies that share its blocks,
+        on file systems such as XFS and Btrfs). Every file in a group must
+        have the same full hash; at defcon 4 and 5 the full hashes are
+        calculated at this point. Files that have changed since they were
+        stat-ed, or that someone else has locked, are left alone. Hard
+        links are only made between files with the same owner, group,
+        and mode on the same device.
+
     --small-file :: Some programs create hundreds or thousands of very
         small files. Many may be short lived duplicates. The default value
         of 4097 bytes means that a file must be at least that large
         to even figure into our calculus.
 
+    --spill-dir :: Where to write the temporary files for --memory-budget.
+        The default is $TMPDIR, or /tmp. A local disc is best. The files
+        are deleted when the program ends. With --export, the files are
+        read back and hashed again, because the hashes are not kept.
+
+    --time-budget :: In seconds. When the time is up, the program stops
+        looking and writes what it has found. The groups that could free
+        the most space (the space on disc of the extra copies, which for
+        sparse files is less than their size) are hashed first, so what
+        has been found is the biggest part of the problem. Among groups
+        that could free the same space, those whose files each have the
+        same name and modification time as another, and are almost 
+        certainly copies, come first. With the csv format,
+        each group is written to the report as soon as it is confirmed,
+        so even a job that is killed leaves a useful report behind.
+        Nothing is reclaimed by a run that did not finish.
+
     --units :: By default, file sizes are reported in the bytes (B). However,
         G, M, K and X are availble, where X is autoscale. 
 
-    --verbose :: Provides more information as the program runs. This 
-        switch is superseded by --quiet.
+    --verbose :: Reports progress every second, unless --progress says
+        otherwise. This switch is superseded by --quiet.
 
     --version :: The program always prints its version at the beginning
         of (non-quiet) execution, but if this switch is given on the 
         command line, the program prints its version and stops.
 
+    --watch :: After the directory has been scanned once, keep running
+        and use inotify to follow the changes to it. The current duplicate
+        groups are available on the named Unix socket; for example,
+        "python watch.py /tmp/funiq.sock groups" or "... stats". No
+        report file is written in this mode.
+
     --young-file :: The value is in days, so if a long calculation is
         running, then we may want to exclude files that are younger
         than the time it has been running. The files are in use, and
@@ -170,45 +266,8 @@ funiq_help = """
     """
 
 quiet = False
-
-def all_files_in(s:str, include_hidden:bool=False) -> str:
-    """
-    A generator to cough up the full file names for every
-    file in a directory.
-    """
-    s = expandall(s)
-    for c, d, files in os.walk(s):
-        for f in files:
-            s = os.path.join(c, f)
-            if not include_hidden and '/.' in s: continue
-            yield s
-
-
-byte_symbols = tuple(list('YZEPTGMB'))
-byte_values = tuple((2<<10)**i for i in range(8,0,-1))
-byte_scaling = dict(zip(byte_symbols, byte_values))
-
-def byte_scale(i:int, key:str='X') -> str:
-    """
-    i -- an integer to scale.
-    key -- a character to use for scaling.
-    """
-    global byte_scaling
-
-    try:
-        if (divisor := byte_scaling[key]) == 1: return i
-    except:
-        return ""
-
-    try:
-        return f"{round(i/divisor, 3)}{key}"
-    except:
-        for k, v in byte_scaling.items():
-            if i > v: return f"{round(i/v, 3)}{k}"
-        else:
-            # How did this happen?
-            return f"Error: byte_scale({i}, {k})"
-
+start_time = time.time()
+report_columns = ('hogsize', 'hogname', 'date', 'owner')
 
 def dump_cmdline(args:argparse.ArgumentParser, return_it:bool=False, split_it:bool=False) -> str:
     """
@@ -225,14 +284,6 @@ def dump_cmdline(args:argparse.ArgumentParser, return_it:bool=False, split_it:bo
     return opt_string if return_it else ""
 
 
-def expandall(s:str) -> str:
-    """
-    Expand all the user vars into an absolute path name. If the 
-    argument happens to be None, it is OK.
-    """
-    return s if s is None else os.path.abspath(os.path.expandvars(os.path.expanduser(s)))
-    
-
 def tprint(s:str) -> None:
     global start_time
     global quiet
@@ -246,164 +297,273 @@ def tprint(s:str) -> None:
 def funiq_main(pargs:argparse.Namespace) -> int:
 
     pargs.exclude.extend(('/proc/', '/dev/', '/mnt/', '/sys/', '/boot/', '/var/'))
+    state = pipeline.ScanState()
+    deadline = start_time + pargs.time_budget if pargs.time_budget else None
 
     ############################################################
-    # Use the generator to collect the files so that we do not
-    # build a useless list in memory. 
+    # Use the generators to collect the files so that we do not
+    # build a useless list in memory. Only the files that share
+    # a size with another file are kept.
     ############################################################
-    tprint(f"Stating directory entries in {pargs.dir}. Each dot represents 1000 files.\n")
-    small_files = 0
-    young_files = 0
-    excluded_files = 0
-    youngest_file = time.time() - pargs.young_file*86400
-    try:
-        for i, f in enumerate(all_files_in(pargs.dir, pargs.include_hidden), start=1):
-            if not pargs.quiet and not i % 1000: 
-                sys.stderr.write('.')
-                sys.stderr.flush()
-            if i > pargs.limit: break
-
-            ######################################################
-            # 1. Is it something the user wants to exclude?
-            # 2. Is it a symlink that we are not following?
-            # 3. Is it qualified after stat-ing it?
-            ######################################################
-            if pargs.exclude and any(_ in f for _ in pargs.exclude): 
-                excluded_files += 1
-                continue 
-            if not pargs.follow_links and os.path.islink(f): continue
-
-            f = fname.Fname(f)
-            if len(f) < pargs.small_file: 
-                small_files += 1
-                continue
-
-            if pargs.young_file and f.DoB > youngest_file:
-                young_files += 1
-                continue
-
-            if f._nlink > 1: 
-                by_inode[f._inode].append(f)
-            else:
-                by_size[len(f)].append(f)
-            
-        sys.stderr.write('\n')
-        sys.stderr.flush()
-        tprint(f"All {i} files have been stat-ed")
+    trie = pathtrie.DirTrie()
+    spilling = pargs.spill_dir is not None or pargs.memory_budget is not None
+    if spilling:
+        budget = pargs.memory_budget or 1<<30
+        state.by_size = extsort.ExternalGrouper(pargs.spill_dir, 
+            memory_budget=budget, shared=(trie,))
+        by_reclaim = extsort.ExternalGrouper(pargs.spill_dir, 
+            memory_budget=budget, reverse=True, shared=(trie,))
+        tprint(f"Keeping at most {budget} bytes of files in memory, and "
+            f"the rest in {pargs.spill_dir or tempfile.gettempdir()}")
 
-    except KeyboardInterrupt as e:
-        pass
+    ###
+    # Progress is reported by a thread of its own, from the counts
+    # in state, so the loops below do no I/O of their own.
+    ###
+    interval = pargs.progress if pargs.progress is not None else (1 if pargs.verbose else 10)
+    reporter = progress.Reporter(state, 0 if pargs.quiet else interval, log=tprint)
+    reporter.start()
+
+    tprint(f"Stating directory entries in {', '.join(pargs.dir)}.")
+    entries = pipeline.scan_roots(pargs.dir, pargs.include_hidden, 
+        one_file_system=pargs.one_file_system)
+    files = pipeline.qualify(pipeline.until(entries, state, deadline), state,
+        exclude=pargs.exclude,
+        follow_links=pargs.follow_links,
+        small_file=pargs.small_file,
+        youngest_file=time.time() - pargs.young_file*86400 if pargs.young_file else None,
+        skip_uids=() if pargs.include_root_files else (0,),
+        trie=trie,
+        limit=pargs.limit)
 
+    ###
+    # Before any file is opened, see what the stat says about them.
+    # The groups that could free the most space go first, and of those
+    # that could free the same, the ones that are copies as far as the
+    # stat can tell. Sorting them means
+    # that every file has been stat-ed by the time the first one 
+    # comes out.
+    ###
+    size_dups = pipeline.classify(pipeline.group_by_size(files, state), state)
+    size_dups = pipeline.prioritize(size_dups, by_reclaim if spilling else None)
+    first_groups = list(itertools.islice(size_dups, 16))
+    size_dups = itertools.chain(first_groups, size_dups)
+    tprint(f"All {state.files_seen} files have been stat-ed")
+
+    tprint(f"{state.excluded_files} files not considered due to explicit exclusion.")
+    tprint(f"{state.small_files} files not considered due to small size.")
+    tprint(f"{state.young_files} files not considered due to recent activity.")
+    tprint(f"{state.owner_files} files not considered because they belong to root.")
+    tprint(f"There were {len(state.by_inode)} pseudo-duplicates found.")
+    if spilling:
+        tprint(f"{len(state.by_size)} files were sorted by size in "
+            f"{len(state.by_size.runs)+1} runs.")
+    else:
+        tprint(f"Filtering {len(state.by_size)} file sizes.")
 
-    tprint(f"{excluded_files} files not considered due to explicit exclusion.")
-    tprint(f"{small_files} files not considered due to small size.")
-    tprint(f"{young_files} files not considered due to recent activity.")
-    tprint(f"There were {len(by_inode)} pseudo-duplicates found.")
-    tprint(f"Filtering {len(by_size)} file sizes.")
+    blocks = 64 if pargs.defcon == 4 else 1
+    tprint(f"{state.size_candidates} files to examine in {state.size_groups} size groups.")
+    tprint(f"{state.certain_groups} groups are copies as far as the stat can tell, "
+        f"with {state.likely_copies} files that have the same name and mtime as another.")
+    tprint(f"{state.sparse_files} sparse or compressed files; {state.unallocated_bytes} unallocated bytes.")
 
     ###
-    # by_size is a dict(int, list(fname)) If the len of the list(fname) is
-    #   only 1, then that file is unique.
+    # Find out how to read files on the file systems of the roots, 
+    # using the first of the files we are going to read anyway.
     ###
-    size_dups = {k:v for k,v in by_size.items() if len(v) > 1}
-    n_potential_duplicates = sum(len(v) for v in size_dups.values())
-    blocks = 64 if pargs.defcon == 4 else 1
-    tprint(f"{n_potential_duplicates} files to examine in {len(size_dups)} size groups.")
-    tprint(f"Hashing {blocks} blocks of each file. Each # represents 1000 files hashed.")
-
-    # No need to the look through the whole dict at once, the 
-    # potential duplicates are all associated with the same 
-    # size_dups key.
-    true_duplicates = collections.defaultdict()
-    edge_detections = 0
-    
+    if pargs.io_tune == 'off':
+        io_plan = iotune.IOPlan(pargs.dir[0])
+    else:
+        io_plan = iotune.plan_for(pargs.dir, 
+            (f for _, v in first_groups for f in v),
+            probe=pargs.io_tune == 'auto')
+    if pargs.export: io_plan.edge_block = exchange.EDGE_BLOCK
+    if pargs.cold_days is not None: io_plan.cold_age = pargs.cold_days * 86400
+    io_plan.apply()
+    state.metrics['io'] = io_plan.as_dict()
+    tprint(f"I/O plan: {state.metrics['io']}")
+
+    tprint(f"Hashing {blocks} blocks of each file.")
+
     ###
-    # size_dups is a dict(int, list(fname))
+    # Each stage yields (size, list(fname)) where every file in the
+    # list is still a candidate duplicate of the others. Each group 
+    # is in the report as soon as it is confirmed, so that the report
+    # is worth having even if we run out of time.
     ###
-    hash_count = 0
-    for _, candidates in size_dups.items():
-        temp = collections.defaultdict(list)
-
-        # Let's build an table of the hashes of the edges of 
-        # the file to start. If the edges differ, we will not
-        # need to hash the whole file. Put the whole Fname obj
-        # as the value so that we can invoke the full hash
-        # if we need to in the next step.
-        for f in candidates:
-            hash_count += 1
-            if not hash_count % 1000: 
-                sys.stderr.write('#')
-                sys.stderr.flush()
-            not pargs.quiet and pargs.verbose and print(f)
-            temp[f.edge_hash(blocks)].append(f)
- 
-        ###
-        # temp is a dict(hash, list(fname))
-        ###
-        unique_hashes = {k for k in temp if len(temp[k]) == 1}
-        edge_detections += len(unique_hashes)
-
-        # Shrink temp a little, we hope. We are keeping the ones
-        # that had the same edge hash.
-
-        ###
-        # temp is a dict(hash, list(fname)) where the edge_hash was identical.
-        ###
-        temp = {k:v for k, v in temp.items() if k not in unique_hashes}
+    groups = pipeline.until(size_dups, state, deadline)
+    groups = pipeline.edge_hash_groups(groups, state, blocks, io_plan.workers, deadline,
+        io_plan.edge_block, io_plan.bufsize, io_plan.cold_age)
+    if pargs.defcon < 4:
+        groups = pipeline.full_hash_groups(groups, state, io_plan.workers, deadline,
+            io_plan.bufsize, io_plan.cold_age)
+    groups = pipeline.account(pipeline.confirmed(groups, state), state, pargs.dir)
+
+    tprint(f"Writing results to {report_name(pargs)} as they are found.")
+    streaming = pargs.format == 'csv'
+    if streaming:
+        report = open(report_name(pargs), 'w', newline='')
+        writer = csv.writer(report)
+        writer.writerow(report_columns)
+
+    ###
+    # The groups are only kept if something is done with them after
+    # the search: replacing the files, or a format that cannot be 
+    # written a piece at a time. With a memory budget, they are kept
+    # on disc as the files were.
+    ###
+    keeping = pargs.reclaim or not streaming
+    kept = []
+    if keeping and spilling:
+        kept = extsort.ExternalGrouper(pargs.spill_dir, 
+            memory_budget=budget, shared=(trie,))
+    num_groups = num_dups = 0
+
+    def true_duplicates() -> Iterator[Tuple[int, List[fname.Fname]]]:
+        if isinstance(kept, list):
+            yield from kept
+            return
+        for size, same in kept.items():
+            for files in same: yield size, files
+
+    try:
+        for size, files in groups:
+            num_groups += 1
+            num_dups += len(files)
+            if keeping and spilling: 
+                kept.add(size, files, len(files))
+            elif keeping:
+                kept.append((size, files))
+            if streaming:
+                writer.writerows(pipeline.report_rows(((size, files),), pargs.units))
+                report.flush()
+
+    except KeyboardInterrupt as e:
+        state.interrupted = True
+
+    finally:
+        reporter.stop()
+        if streaming: report.close()
+
+    if state.out_of_time:
+        tprint(f"The time budget of {pargs.time_budget} seconds ran out; the report is incomplete.")
+    if state.interrupted:
+        tprint(f"Interrupted; the report is incomplete.")
+    tprint(f"Eliminated {state.edge_detections} files with edge hashing.")
+    if state.unreadable_files: tprint(f"{state.unreadable_files} files could not be read, and are not in the report.")
+    tprint(f"Found {num_dups} (probable) duplicated files representing {num_groups} unique files.")    
+
+    if pargs.reclaim and (state.out_of_time or state.interrupted):
+        tprint(f"Not replacing any files because the search did not finish.")
+    elif pargs.reclaim:
+        tprint(f"Replacing duplicates with {pargs.reclaim}s{' (dry run)' if pargs.dry_run else ''}.")
+        r = reclaim.reclaim(true_duplicates(), pargs.reclaim, pargs.dry_run, log=tprint)
+        state.metrics['reclaim'] = r.as_dict()
+        tprint(f"{r.replaced} files in {r.groups} groups {'would be' if r.dry_run else 'were'} replaced, "
+            f"freeing {byte_scale(r.freed, pargs.units)}.")
+        if r.to_verify: 
+            tprint(f"{byte_scale(r.to_verify, pargs.units)} would have to be read to verify them.")
+        if r.skipped: 
+            tprint(f"Skipped: {dict(r.skipped)}")
+
+    # The other formats cannot be written a piece at a time.
+    if not streaming:
+        write_table(pandas.DataFrame(pipeline.report_rows(true_duplicates(), pargs.units),
+            columns=report_columns), pargs)
+
+    # The rollups were added up as the groups were confirmed.
+    write_table(pandas.DataFrame(pipeline.owner_rows(state, pargs.units),
+        columns=('owner', 'uid', 'files', 'dupbytes')), pargs, 'owners')
+    write_table(pandas.DataFrame(pipeline.dir_rows(state, pargs.units),
+        columns=('directory', 'files', 'dupbytes')), pargs, 'dirs')
+
+    # An export says what is on this host, so half of one would make
+    # a join miss files; and it would read every file, deadline or not.
+    if pargs.export and (state.out_of_time or state.interrupted):
+        tprint(f"Not exporting because the search did not finish.")
+    elif pargs.export:
+        tprint(f"Exporting the hashes of the files to {pargs.export}")
+        n = exchange.export(state.by_size, pargs.export, 
+            host=pargs.host, 
+            blocks=blocks, 
+            full=pargs.defcon < 4, 
+            workers=io_plan.workers,
+            bufsize=io_plan.bufsize,
+            cold_age=io_plan.cold_age,
+            linked=state.by_inode)
+        tprint(f"{n} files exported.")
         
-        if pargs.defcon < 4:
-            # Note that we don't care about the value of the edge_hash,
-            # and that means we can use a view of the values.
-            full_hashes = collections.defaultdict(list)
-            for v in temp.values():
-                for f in v:
-                    full_hashes[f.hash].append(f)
-        else:
-            full_hashes = temp
-
-        ###
-        # full_hashes is a dict(hash, list(fname))
-        ###
-        unique_hashes = {k for k in full_hashes if len(full_hashes[k]) == 1}
-        duplicate_hashes = {k:v for k, v in full_hashes.items() if k not in unique_hashes}
-        for v in duplicate_hashes.values():
-            true_duplicates[len(v[0])] = v
-
-    num_dups = sum(len(v) for v in true_duplicates.values())
-    hogs = sorted(true_duplicates.keys(), reverse=True)
-    sys.stderr.write("\n")
-    tprint(f"Eliminated {edge_detections} files with edge hashing.")
-    tprint(f"Found {num_dups} (probable) duplicated files representing {len(hogs)} unique files.")    
-
-    tprint(f"Writing results to {pargs.output}")
-
-    # The for-loop will be empty if there are no hogs, so no need to
-    # purposefully ignore this statement.
-    true_duplicates = dict(sorted(true_duplicates.items(), reverse=True))
-
-    # Note: the str(f) is for clarity. When passing the Fname object to
-    # pandas, pandas cannot makes sense of it, and its default
-    # behavior is to invoke the object's str representation, which
-    # Python guarantees us is available. 
-    row_generator = ((byte_scale(hogsize, pargs.units), 
-            str(f), 
-            datetime.date.fromtimestamp(int(f.DoB))) 
-        for hogsize, files in true_duplicates.items() 
-            for f in files)
-
-    df = pandas.DataFrame(row_generator,
-        columns=('hogsize', 'hogname', 'date'))
-    
+    return os.EX_OK
+
+
+def funiq_join(pargs:argparse.Namespace) -> int:
+    """
+    Find the files that are on more than one host from their exports.
+    Nothing is scanned.
+    """
+    tprint(f"Joining {len(pargs.join)} exports.")
+    try:
+        groups = list(exchange.join(pargs.join))
+    except (ValueError, OSError) as e:
+        sys.stderr.write(f"{e}\n")
+        return os.EX_DATAERR
+    tprint(f"Found {sum(len(v) for _, v in groups)} files in {len(groups)} groups on more than one host.")
+
+    rows = ( (byte_scale(size, pargs.units), r.host, r.path, (r.edge if r.full == exchange.no_hash else r.full).hex())
+        for size, records in sorted(groups, key=lambda g: g[0] * (len(g[1])-1), reverse=True)
+            for r in records )
+    text = write_table(pandas.DataFrame(rows, 
+        columns=('hogsize', 'host', 'hogname', 'digest')), pargs)
+    tprint(f"Results are in {text}")
+    return os.EX_OK
+
+
+def report_name(pargs:argparse.Namespace, table:str=None) -> str:
+    """
+    The name of one table of the report. The tables other than the 
+    main one have their name inserted before the extension, e.g., 
+    hogreport.owners.csv.
+    """
     foo, ext = converters[pargs.format]
     outfile_name = fname.Fname(pargs.output)
-    text = ( f"{str(outfile_name)}.{ext}" 
+    stem, ext = ( (str(outfile_name), ext) 
         if outfile_name.fqn == outfile_name.all_but_ext else
-        outfile_name.fqn )
-    
+        (outfile_name.all_but_ext, outfile_name.ext[1:]) )
+    return f"{stem}.{table}.{ext}" if table else f"{stem}.{ext}"
+
+
+def write_table(df:pandas.DataFrame, pargs:argparse.Namespace, table:str=None) -> str:
+    """
+    Write one table of the report in the chosen format.
+    """
+    foo, ext = converters[pargs.format]
+    text = report_name(pargs, table)
     result = getattr(df, foo)(text, index=False)
-        
-    # Now we need to hash the files that remain. Edges first.
-    return os.EX_OK
+    return text
+
+
+def funiq_watch(pargs:argparse.Namespace) -> int:
+    """
+    Build the index once, and then keep it current until interrupted.
+    """
+    if len(pargs.dir) > 1:
+        sys.stderr.write("--watch follows only one --dir.\n")
+        return os.EX_USAGE
+
+    pargs.exclude.extend(('/proc/', '/dev/', '/mnt/', '/sys/', '/boot/', '/var/'))
+    w = watch.Watcher(pargs.dir[0],
+        include_hidden=pargs.include_hidden,
+        exclude=pargs.exclude,
+        follow_links=pargs.follow_links,
+        one_file_system=pargs.one_file_system,
+        small_file=pargs.small_file,
+        young_file=pargs.young_file,
+        skip_uids=() if pargs.include_root_files else (0,),
+        blocks=64 if pargs.defcon == 4 else 1,
+        full=pargs.defcon < 4,
+        log=tprint)
+    tprint(f"Building the index of {pargs.dir[0]}")
+    return w.serve(pargs.watch)
 
 
 if __name__ == "__main__":
@@ -416,12 +576,17 @@ if __name__ == "__main__":
 
     parser.add_argument('--batch', action='store_true', help='no user prompts.')
 
+    parser.add_argument('--cold-days', type=float, default=None,
+        help="read files that have not changed in this many days without using the page cache.")
+
     parser.add_argument('--defcon', type=int, choices=range(1,6),
         default=5, help="The defcon level. For more info, use help.")
 
-    parser.add_argument('--dir', type=str, 
-        default=expandall(os.getcwd()),
-        help="directory to investigate (if not *this* directory)")
+    parser.add_argument('--dir', type=str, action='append', default=[],
+        help="directory to investigate (if not *this* directory). May be repeated.")
+
+    parser.add_argument('--dry-run', action='store_true',
+        help="with --reclaim, only report what would be done.")
 
     parser.add_argument('-x', '--exclude', action='append', 
         default=[],
@@ -430,29 +595,64 @@ if __name__ == "__main__":
     parser.add_argument('--follow-links', action='store_true',
         help="follow symbolic links -- the default is not to.")
 
+    parser.add_argument('--export', type=str, default=None,
+        help="also write the hashes of all the files here, to be joined with other hosts'.")
+
     parser.add_argument('-f', '--format', type=str, default='csv',
         choices=converters.keys(),
         help="Format for the report on activities.")
 
+    parser.add_argument('--host', type=str, default=socket.gethostname(),
+        help="the name of this host in an --export.")
+
+    parser.add_argument('--include-root-files', action='store_true',
+        help="consider files owned by root, too.")
+
     parser.add_argument('--include-hidden', action='store_true',
         help="search hidden directories as well.")
 
+    parser.add_argument('--io-tune', type=str, default='auto',
+        choices=('auto', 'table', 'off'),
+        help="how to choose read sizes and the number of readers.")
+
+    parser.add_argument('--join', type=str, nargs='+', default=None,
+        help="do not scan; find the files in more than one of these exports.")
+
     parser.add_argument('--limit', type=int, default=sys.maxsize,
         help="Limit the number of files considered for testing purposes.")
 
+    parser.add_argument('--memory-budget', type=extsort.parse_size, default=None,
+        help="sort the files on disc, keeping about this much (e.g., 4G) in memory.")
+
     parser.add_argument('--nice', type=int, default=20, choices=range(0, 21),
         help="by default, this program runs /very/ nicely at nice=20")
 
     parser.add_argument('-o', '--output', type=str, default="duplicatefiles.csv",
         help="Output file with the duplicates files' names. Default is <duplicatefiles.csv>")
 
+    parser.add_argument('--one-file-system', action='store_true',
+        help="do not descend into other file systems mounted below --dir.")
+
+    parser.add_argument('--progress', type=float, default=None,
+        help="seconds between reports of progress (default 10; 0 for none).")
+
     parser.add_argument('--quiet', action='store_true',
         help="eliminates narrative while running except for errors.")
 
+    parser.add_argument('--reclaim', type=str, default=None,
+        choices=reclaim.methods,
+        help="replace verified duplicates with hard links or reflinks.")
+
     parser.add_argument('--small-file', type=int, 
         default=resource.getpagesize()+1,
         help=f"files less than this size (default {resource.getpagesize()+1}) are not evaluated.")
 
+    parser.add_argument('--spill-dir', type=str, default=None,
+        help="sort the files on disc, in this directory.")
+
+    parser.add_argument('--time-budget', type=float, default=0,
+        help="stop looking after this many seconds, and report what has been found.")
+
     parser.add_argument('--units', type=str, 
         default="B", 
         choices=byte_symbols,
@@ -465,12 +665,16 @@ K, M, G, or X (auto scale), instead""")
     parser.add_argument('--version', action='store_true', 
         help='Print the version and exit.')
 
+    parser.add_argument('--watch', type=str, default=None, metavar='SOCKET',
+        help="keep running, and answer queries about duplicates on this Unix socket.")
+
     parser.add_argument('--young-file', type=int, default=0, 
         help="If a file is younger than this value in days, "\
             "it is ignored for the purpose of determining duplicates. "\
             "The default is to consider all files.")
 
     pargs = parser.parse_args()
+    pargs.dir = [ expandall(_) for _ in pargs.dir ] or [ expandall(os.getcwd()) ]
     if pargs.version:
         print(f"Version {__version__}")
         sys.exit(os.EX_OK)
@@ -490,4 +694,5 @@ K, M, G, or X (auto scale), instead""")
 
     start_time = time.time()
     os.nice(pargs.nice)
-    sys.exit(funiq_main(pargs))
+    if pargs.join: sys.exit(funiq_join(pargs))
+    sys.exit(funiq_watch(pargs) if pargs.watch else funiq_main(pargs))
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+Choose how to read the files on a particular file system. What is
+fast on a local NVMe drive (small reads, a few readers) is slow on
+Lustre or NFS (big reads, many readers), so we find out what the
+file system is, start from what usually works there, and then
+time a few reads of the files we are about to hash.
+
+       p = plan('/scratch', samples)
+       p.apply()
+       print(p.as_dict())
+
+The plan is not kept anywhere global; the stages that read the files
+are given its sizes, so that two scans in one process can each have
+their own.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import concurrent.futures
+import copy
+import io
+import time
+
+import bufpool
+import fname
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+KiB = 1<<10
+MiB = 1<<20
+
+###
+# fstype : (bytes per read, number of readers). Network and parallel
+# file systems pay for each round trip, so they want big reads and
+# a lot of them in flight. Anything not in the table is taken to be
+# local, and a spinning disc gets only one reader.
+###
+fs_defaults = {
+    'nfs':      (1*MiB, 8),
+    'nfs4':     (1*MiB, 8),
+    'lustre':   (1*MiB, 16),
+    'gpfs':     (4*MiB, 8),
+    'beegfs':   (1*MiB, 8),
+    'cephfs':   (4*MiB, 8),
+    'ceph':     (4*MiB, 8),
+    'cifs':     (1*MiB, 4),
+    'smb3':     (1*MiB, 4)
+    }
+
+local_defaults = (256*KiB, 4)
+rotational_defaults = (1*MiB, 1)
+
+probe_sizes = (64*KiB, 256*KiB, 1*MiB, 4*MiB)
+
+
+class IOPlan:
+    """
+    What we know about the file system, and what we decided to do
+    about it.
+    """
+
+    def __init__(self, top:str):
+        self.top = top
+        self.fstype = 'unknown'
+        self.mountpoint = '/'
+        self.blksize = io.DEFAULT_BUFFER_SIZE
+        self.rotational = False
+        self.edge_block = io.DEFAULT_BUFFER_SIZE
+        self.bufsize = io.DEFAULT_BUFFER_SIZE
+        self.workers = 1
+        self.cold_age = None
+        self.probe_rate = 0.0
+        self.source = 'default'
+
+
+    def apply(self) -> None:
+        """
+        Have a buffer waiting for each reader. Nothing else is changed;
+        pass edge_block, bufsize, and cold_age to the hashing stages.
+        """
+        bufpool.pool(self.bufsize).preallocate(self.workers)
+
+
+    def as_dict(self) -> dict:
+        return {'fstype':self.fstype,
+            'mountpoint':self.mountpoint,
+            'blksize':self.blksize,
+            'rotational':self.rotational,
+            'edge_block':self.edge_block,
+            'bufsize':self.bufsize,
+            'workers':self.workers,
+            'cold_age':self.cold_age,
+            'probe_MBps':round(self.probe_rate/MiB, 1),
+            'source':self.source}
+
+
+def filesystem_of(path:str) -> Tuple[str, str]:
+    """
+    returns: -- (fstype, mountpoint) of the mount that contains path,
+        according to the longest matching mount point in /proc/self/mounts.
+    """
+    path = os.path.realpath(path)
+    best = ('unknown', '/')
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3: continue
+                mnt = fields[1].replace('\\040', ' ').replace('\\011', '\t')
+                inside = path == mnt or path.startswith(mnt.rstrip('/') + '/')
+                if inside and len(mnt) >= len(best[1]):
+                    best = (fields[2], mnt)
+    except OSError as e:
+        pass
+
+    return best
+
+
+def is_rotational(path:str) -> bool:
+    """
+    returns: -- True if the block device under path says it spins. Network
+        file systems have no block device, and are not.
+    """
+    try:
+        dev = os.stat(path).st_dev
+        base = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+        for q in (f"{base}/queue/rotational", f"{base}/../queue/rotational"):
+            if os.path.exists(q):
+                with open(q) as f:
+                    return f.read().strip() == '1'
+    except OSError as e:
+        pass
+
+    return False
+
+
+def _read_rate(files:List[str], bufsize:int, workers:int, budget:int, offsets:dict) -> float:
+    """
+    Read budget bytes from the files with this many readers, each
+    read bufsize bytes long, and return the bytes per second. Each
+    trial starts where the last one stopped, and the pages are
+    dropped from the cache first, so we are timing the file system
+    rather than memory.
+    """
+    share = budget // workers
+
+    def reader(path:str) -> int:
+        n = 0
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            return 0
+        try:
+            offset = offsets[path]
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, offset, share, os.POSIX_FADV_DONTNEED)
+            while n < share:
+                block = os.pread(fd, bufsize, offset + n)
+                if not block: break
+                n += len(block)
+        finally:
+            os.close(fd)
+        offsets[path] += n
+        return n
+
+    chosen = sorted(files, key=lambda p: offsets[p])[:workers]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        total = sum(pool.map(reader, chosen))
+    elapsed = time.perf_counter() - start
+    return total / elapsed if elapsed > 0 else 0.0
+
+
+def plan(top:str, samples:Iterable[fname.Fname]=(), *,
+        probe:bool=True, budget:int=4*MiB) -> IOPlan:
+    """
+    Decide on the edge block size, the buffer size for full hashes,
+    and the number of readers for the file system that holds top.
+
+    samples -- files on that file system that we are going to read
+        anyway. The biggest of them are used for the timings, and
+        without enough of them we go with the table.
+    budget -- bytes read in each timing.
+    """
+    p = IOPlan(top)
+    p.fstype, p.mountpoint = filesystem_of(top)
+    try:
+        p.blksize = os.stat(top).st_blksize
+    except OSError as e:
+        pass
+    p.rotational = is_rotational(top)
+
+    if p.fstype in fs_defaults:
+        p.bufsize, p.workers = fs_defaults[p.fstype]
+    elif p.rotational:
+        p.bufsize, p.workers = rotational_defaults
+    else:
+        p.bufsize, p.workers = local_defaults
+    p.source = 'table'
+
+    # The edge hash only has to find differences, so one block of
+    # the size the file system prefers is enough. Lustre reports its
+    # stripe size here, and NFS its rsize.
+    p.edge_block = min(max(p.blksize, io.DEFAULT_BUFFER_SIZE), 1*MiB)
+
+    # Reading a hole in a sparse file costs nothing, so they are not
+    # used for the timings.
+    samples = sorted((f for f in samples if not f.sparse), key=len, reverse=True)[:max(p.workers, 4)]
+    files = [str(f) for f in samples]
+    room = sum(len(f) for f in samples)
+    trials = len(probe_sizes) + 1
+    if not probe or len(files) < 2 or room < budget * trials:
+        return p
+
+    offsets = dict.fromkeys(files, 0)
+    rates = {size:_read_rate(files, size, 1, budget, offsets) for size in probe_sizes}
+    p.bufsize = max(rates, key=rates.get)
+    p.probe_rate = rates[p.bufsize]
+
+    # More readers only help if the file system can keep them busy.
+    workers = min(p.workers, len(files))
+    if workers > 1:
+        rate = _read_rate(files, p.bufsize, workers, budget, offsets)
+        if rate > 1.25 * p.probe_rate:
+            p.workers, p.probe_rate = workers, rate
+        else:
+            p.workers = 1
+
+    p.source = 'probe'
+    return p
+
+
+def plan_for(tops:Iterable[str], samples:Iterable[fname.Fname]=(), *,
+        probe:bool=True, budget:int=4*MiB) -> IOPlan:
+    """
+    One plan for several roots, which may be on different file systems.
+    Each file system is planned once, with the samples that are on it.
+    The files in one size group may come from any of the roots, and
+    their edges must be hashed over the same bytes, so the plan takes
+    the largest of each size and the most readers.
+    """
+    tops = list(tops)
+    samples = list(samples)
+    plans, seen = [], set()
+    for top in tops:
+        try:
+            dev = os.stat(top).st_dev
+        except OSError as e:
+            continue
+        if dev in seen: continue
+        seen.add(dev)
+        plans.append(plan(top, (f for f in samples if f._dev == dev),
+            probe=probe, budget=budget))
+
+    if not plans: return IOPlan(tops[0] if tops else '/')
+    if len(plans) == 1: return plans[0]
+
+    p = copy.copy(plans[0])
+    p.top = ','.join(q.top for q in plans)
+    p.fstype = ','.join(q.fstype for q in plans)
+    p.mountpoint = ','.join(q.mountpoint for q in plans)
+    p.rotational = any(q.rotational for q in plans)
+    p.edge_block = max(q.edge_block for q in plans)
+    p.bufsize = max(q.bufsize for q in plans)
+    p.workers = max(q.workers for q in plans)
+    p.probe_rate = min(q.probe_rate for q in plans)
+    p.source = ','.join(q.source for q in plans)
+    return p
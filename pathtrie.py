@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Directory names, each stored once. On a big tree, millions of files
+live in directories with long names in common, e.g.,
+
+       /scratch/alice/project/run_0001/out/x.dat
+
+so instead of keeping the whole name of every file, we keep a number
+for its directory and its own name. The number leads to the name of
+the directory and a number for its parent, and so on up to the root.
+The whole name is only put together when it is asked for.
+
+       t = DirTrie()
+       d = t.intern('/scratch/alice/project')
+       t.path(d) =>> '/scratch/alice/project'
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import functools
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+
+class DirTrie:
+    """
+    Directory 0 is the root, '/'. Every other directory is a name and
+    the number of its parent.
+    """
+
+    ROOT = 0
+
+    def __init__(self, cache_size:int=4096, leaf_size:int=1<<16):
+        """
+        cache_size -- how many whole directory names to remember.
+        leaf_size -- how many file names to share, and how many names
+            seen only once to remember while we wait for them to repeat.
+        """
+        self.parents = [ -1 ]
+        self.names = [ '' ]
+        self.children = {}
+        self.leaves = {}
+        self.once = set()
+        self.cache_size = cache_size
+        self.leaf_size = leaf_size
+
+        # Files come in directory order, so a small cache of whole
+        # names keeps us from climbing the tree for each file.
+        self.path = functools.lru_cache(maxsize=cache_size)(self._path)
+
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        del state['path']
+        return state
+
+
+    def __setstate__(self, state:dict) -> None:
+        self.__dict__.update(state)
+        self.path = functools.lru_cache(maxsize=self.cache_size)(self._path)
+
+
+    def child(self, parent:int, name:str) -> int:
+        """
+        returns: -- the number of the directory called name in parent,
+            adding it if it is new.
+        """
+        key = (parent, name)
+        d = self.children.get(key)
+        if d is None:
+            d = self.children[key] = len(self.names)
+            self.parents.append(parent)
+            self.names.append(sys.intern(name))
+        return d
+
+
+    def leaf(self, name:str) -> str:
+        """
+        returns: -- one shared copy of the name of a file. Trees of 
+            checkpoints and runs use the same few file names over and 
+            over, in directory after directory. Where the names do not
+            repeat, keeping a copy of each would cost more than it 
+            saves, so a name is only shared from the second time it 
+            is seen, and neither table grows past leaf_size.
+        """
+        shared = self.leaves.get(name)
+        if shared is not None: return shared
+
+        if name in self.once:
+            self.once.discard(name)
+            if len(self.leaves) < self.leaf_size: self.leaves[name] = name
+        else:
+            if len(self.once) >= self.leaf_size: self.once.clear()
+            self.once.add(name)
+        return name
+
+
+    def intern(self, path:str) -> int:
+        """
+        returns: -- the number of a fully qualified directory name.
+        """
+        d = DirTrie.ROOT
+        for name in path.split(os.sep):
+            if name: d = self.child(d, name)
+        return d
+
+
+    def _path(self, d:int) -> str:
+        """
+        returns: -- the fully qualified name of directory number d.
+        """
+        parts = []
+        while d > DirTrie.ROOT:
+            parts.append(self.names[d])
+            d = self.parents[d]
+        return os.sep + os.sep.join(reversed(parts))
@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+
+"""
+The stages of a funiq run, as composable generators. Each stage
+consumes the output of the one before it, and all the bookkeeping
+lives in a ScanState object rather than in module globals, so
+more than one scan may be run in the same process.
+
+       state  = ScanState()
+       paths  = scan('/scratch')
+       files  = qualify(paths, state, small_file=4097)
+       groups = group_by_size(files, state)
+       groups = prioritize(classify(groups, state))
+       groups = edge_hash_groups(groups, state)
+       groups = full_hash_groups(groups, state)
+       for size, files in groups:
+           ...
+
+Any stage may be replaced by a caller's own generator provided
+that it yields the same things: scanners yield fully qualified
+path names or os.DirEntry objects, and every stage after
+group_by_size yields (size, [Fname, ...]) tuples in which every
+Fname has the same contents as far as that stage can tell.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import collections
+import concurrent.futures
+import datetime
+import functools
+import pwd
+import queue
+import stat
+import threading
+import time
+
+import extsort
+import fname
+import pathtrie
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+
+byte_symbols = tuple(list('YZEPTGMB'))
+byte_values = tuple((2<<10)**i for i in range(8,0,-1))
+byte_scaling = dict(zip(byte_symbols, byte_values))
+
+def byte_scale(i:int, key:str='X') -> str:
+    """
+    i -- an integer to scale.
+    key -- a character to use for scaling.
+    """
+    global byte_scaling
+
+    try:
+        if (divisor := byte_scaling[key]) == 1: return i
+    except:
+        return ""
+
+    try:
+        return f"{round(i/divisor, 3)}{key}"
+    except:
+        for k, v in byte_scaling.items():
+            if i > v: return f"{round(i/v, 3)}{k}"
+        else:
+            # How did this happen?
+            return f"Error: byte_scale({i}, {k})"
+
+
+def expandall(s:str) -> str:
+    """
+    Expand all the user vars into an absolute path name. If the
+    argument happens to be None, it is OK.
+    """
+    return s if s is None else os.path.abspath(os.path.expandvars(os.path.expanduser(s)))
+
+
+class ScanState:
+    """
+    Everything a scan learns along the way. The stages only ever
+    add to it, so a caller may look at it between stages, or after
+    the last group has been consumed.
+    """
+
+    def __init__(self):
+        ####
+        # To look for pseudo duplicates that are actually hard links.
+        ####
+        self.by_inode = collections.defaultdict(list)
+
+        ####
+        # To look for files that are the same size. A caller who
+        # expects more files than will fit in memory may put an
+        # extsort.ExternalGrouper here instead.
+        ####
+        self.by_size = collections.defaultdict(list)
+
+        self.files_seen = 0
+        self.excluded_files = 0
+        self.small_files = 0
+        self.young_files = 0
+        self.size_groups = 0
+        self.size_candidates = 0
+        self.sparse_files = 0
+        self.unallocated_bytes = 0
+        self.likely_copies = 0
+        self.certain_groups = 0
+        self.groups_examined = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.edge_detections = 0
+        self.hash_detections = 0
+        self.unreadable_files = 0
+        self.confirmed_groups = 0
+        self.owner_files = 0
+        self.interrupted = False
+        self.out_of_time = False
+
+        ####
+        # Who has the duplicates, and where. The counts are of the
+        # copies beyond the first, so they add up to what could be
+        # reclaimed.
+        ####
+        self.files_by_owner = collections.Counter()
+        self.bytes_by_owner = collections.Counter()
+        self.files_by_dir = collections.Counter()
+        self.bytes_by_dir = collections.Counter()
+
+        ####
+        # Anything worth reporting about how the run was done.
+        ####
+        self.metrics = {}
+
+
+def scan(top:str, include_hidden:bool=False, *,
+        one_file_system:bool=False,
+        skip:Container[str]=frozenset()) -> Iterator[os.DirEntry]:
+    """
+    A generator to cough up the directory entry for every file in
+    a directory. The entries carry the results of the stat along
+    with them, so nothing downstream needs to stat the file again.
+    As with os.walk, symbolic links to directories are not followed.
+
+    one_file_system -- do not go into directories that are mount 
+        points of other file systems.
+    skip -- directories not to go into, usually because they are 
+        being scanned by someone else.
+    """
+    top = expandall(top)
+    if one_file_system:
+        try:
+            top_dev = os.stat(top).st_dev
+        except OSError as e:
+            return
+
+    stack = [top]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if not include_hidden and '/.' in entry.path: continue
+                    try:
+                        if not entry.is_dir():
+                            yield entry
+                        elif entry.is_symlink() or entry.path in skip:
+                            continue
+                        elif one_file_system and entry.stat(follow_symlinks=False).st_dev != top_dev:
+                            continue
+                        else:
+                            stack.append(entry.path)
+                    except OSError as e:
+                        continue
+        except OSError as e:
+            continue
+
+
+def scan_roots(tops:Iterable[str], include_hidden:bool=False, *,
+        one_file_system:bool=False,
+        batch:int=1000) -> Iterator[os.DirEntry]:
+    """
+    Scan several directories at once, with one thread for each 
+    device, so that a slow file system does not hold up the others.
+    A directory inside another one is only scanned once. The entries
+    are stat-ed by the thread that finds them, and handed over in
+    batches.
+    """
+    tops = list(dict.fromkeys(expandall(_) for _ in tops))
+    if len(tops) == 1:
+        yield from scan(tops[0], include_hidden, one_file_system=one_file_system)
+        return
+
+    by_device = collections.defaultdict(list)
+    for top in tops:
+        try:
+            by_device[os.stat(top).st_dev].append(top)
+        except OSError as e:
+            continue
+    skip = frozenset(tops)
+
+    entries = queue.Queue(maxsize=64)
+    stop = threading.Event()
+
+    def worker(roots:List[str]) -> None:
+        try:
+            found = []
+            for top in roots:
+                for entry in scan(top, include_hidden, one_file_system=one_file_system, skip=skip):
+                    if stop.is_set(): return
+                    try:
+                        entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        continue
+                    found.append(entry)
+                    if len(found) >= batch:
+                        entries.put(found)
+                        found = []
+            entries.put(found)
+        finally:
+            entries.put(None)
+
+    workers = [ threading.Thread(target=worker, args=(roots,), daemon=True)
+        for roots in by_device.values() ]
+    for w in workers: w.start()
+
+    try:
+        running = len(workers)
+        while running:
+            found = entries.get()
+            if found is None:
+                running -= 1
+            else:
+                yield from found
+
+    finally:
+        # If we were not read to the end, let the workers go.
+        stop.set()
+        while any(w.is_alive() for w in workers):
+            try:
+                entries.get(timeout=0.1)
+            except queue.Empty as e:
+                pass
+
+
+def qualify(paths:Iterable[Union[str, os.DirEntry]], state:ScanState, *,
+        exclude:Iterable[str]=(),
+        follow_links:bool=False,
+        small_file:int=0,
+        youngest_file:float=None,
+        skip_uids:Container[int]=(),
+        trie:pathtrie.DirTrie=None,
+        limit:int=sys.maxsize) -> Iterator[fname.Fname]:
+    """
+    Turn the path names (or directory entries) into Fname objects,
+    dropping the ones that cannot matter:
+
+    1. Is it something the user wants to exclude?
+    2. Is it a regular file? Symlinks that we are not following,
+        FIFOs, sockets, and devices are not; opening a FIFO would
+        wait for a writer that may never come.
+    3. Is it qualified after stat-ing it? That is, is it big enough,
+        old enough, and not owned by one of skip_uids?
+
+    Each file is stat-ed once, and the small and young files are
+    dropped before an Fname is built for them. If there is a trie,
+    the Fname objects keep only the names of the files, and their
+    directories are kept in the trie.
+    """
+    exclude = tuple(exclude)
+    last_dir, dir_id = None, -1
+    for i, f in enumerate(paths, start=1):
+        if i > limit: break
+        state.files_seen = i
+
+        entry = None if isinstance(f, str) else f
+        path = f if entry is None else entry.path
+        if exclude and any(_ in path for _ in exclude):
+            state.excluded_files += 1
+            continue
+
+        try:
+            if entry is None:
+                st = os.stat(path) if follow_links else os.lstat(path)
+            else:
+                st = entry.stat(follow_symlinks=follow_links)
+        except OSError as e:
+            continue
+        if not stat.S_ISREG(st.st_mode): continue
+
+        if st.st_size < small_file:
+            state.small_files += 1
+            continue
+
+        if youngest_file is not None and st.st_mtime > youngest_file:
+            state.young_files += 1
+            continue
+
+        if st.st_uid in skip_uids:
+            state.owner_files += 1
+            continue
+
+        if trie is None:
+            yield fname.Fname.from_stat(path, st)
+            continue
+
+        # The files in a directory come together, so most of the
+        # time the directory is the same as last time.
+        d, name = os.path.split(path)
+        if d != last_dir:
+            last_dir, dir_id = d, trie.intern(d)
+        yield fname.Fname.from_stat(trie.leaf(name), st, trie, dir_id)
+
+
+def group_by_size(files:Iterable[fname.Fname],
+        state:ScanState) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    Files with a unique size are unique files, so nothing is yielded
+    until every file has been seen. Files with more than one link
+    are set aside in state.by_inode, by (device, inode), rather
+    than compared.
+
+    A KeyboardInterrupt while the files are being collected stops
+    the collection, and the groups found so far are yielded.
+
+    If state.by_size is an extsort.ExternalGrouper, the groups come
+    out in order of size, and only one of them is in memory at a time.
+    """
+    table = state.by_size
+    if isinstance(table, extsort.ExternalGrouper):
+        add = table.add
+    else:
+        add = lambda size, f: table[size].append(f)
+
+    try:
+        for f in files:
+            if f._nlink > 1:
+                state.by_inode[f._dev, f._inode].append(f)
+            else:
+                add(len(f), f)
+
+    except KeyboardInterrupt as e:
+        state.interrupted = True
+
+    for size, candidates in table.items():
+        if len(candidates) < 2: continue
+        state.size_groups += 1
+        state.size_candidates += len(candidates)
+        yield size, candidates
+
+
+def twins(files:Iterable[fname.Fname]) -> collections.Counter:
+    """
+    returns: -- how many of the files have each (mtime, name). Files
+        of the same size that agree on both are almost certainly 
+        copies of one another.
+    """
+    return collections.Counter((f._DoB, f.fname) for f in files)
+
+
+def certain(files:List[fname.Fname]) -> bool:
+    """
+    returns: -- True if the stat alone says that the files are copies:
+        each has a twin, or none has any data on disc (so they are all
+        zeros, which hashing them will confirm without reading them).
+    """
+    return ( all(n > 1 for n in twins(files).values()) or
+        all(f._blocks == 0 for f in files) )
+
+
+def worth(group:Tuple[int, List[fname.Fname]]) -> Tuple[int, bool]:
+    """
+    returns: -- (bytes, certain) for a group, where bytes is what could
+        be freed if the files are all the same: the space on disc of
+        all but one of them. For sparse files that is less than their
+        length. The groups that are certain are still hashed in full,
+        so being certain only breaks ties.
+    """
+    size, files = group
+    allocated = [ f.allocated for f in files ]
+    return sum(allocated) - max(allocated), certain(files)
+
+
+def classify(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        state:ScanState) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    Count what the stat says about the candidates before any of them is
+    opened: files with fewer bytes allocated than their length, which
+    are sparse (only their data is read; the holes are hashed as zeros)
+    or compressed by the file system, files with the same mtime and name
+    as another of the same size, and the groups that are copies as far as the stat can
+    tell. The groups go through unchanged; prioritize() puts them in
+    order.
+    """
+    for size, candidates in groups:
+        for f in candidates:
+            if f.sparse:
+                state.sparse_files += 1
+                state.unallocated_bytes += size - f.allocated
+        state.likely_copies += sum(n-1 for n in twins(candidates).values())
+        state.certain_groups += certain(candidates)
+        yield size, candidates
+
+
+def prioritize(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        table:extsort.ExternalGrouper=None) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    Put first the groups that could free the most space, so that the
+    biggest hogs are confirmed first if time runs short, and of those
+    that could free the same, the ones that are copies as far as the
+    stat can tell. See worth().
+
+    table -- if the groups will not fit in memory, an ExternalGrouper
+        (with reverse=True) to sort them in.
+    """
+    if table is None:
+        yield from sorted(groups, key=worth, reverse=True)
+        return
+
+    for size, candidates in groups:
+        table.add(worth((size, candidates)), (size, candidates), len(candidates))
+    for _, same in table.items():
+        yield from same
+    table.clear()
+
+
+def until(items:Iterable, state:ScanState, deadline:float=None) -> Iterator:
+    """
+    Pass the items along until time.time() reaches the deadline, and
+    then stop, as if there were no more. Any stage may be cut short 
+    this way; everything after it finishes what it has.
+    """
+    if deadline is None:
+        yield from items
+        return
+
+    for item in items:
+        if time.time() >= deadline:
+            state.out_of_time = True
+            return
+        yield item
+
+
+def in_parallel(fn:Callable, items:Iterable, workers:int=1) -> Iterator:
+    """
+    map(fn, items), with up to workers calls running at once. The
+    results come back in order, and only a few items are taken
+    ahead of the one being returned, so the stages stay streams.
+    Reading and hashing both let go of the GIL, so threads are
+    enough.
+    """
+    if workers < 2:
+        yield from map(fn, items)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        # If fn raises, or the caller stops early, the items that
+        # have not been started are not started.
+        finally:
+            for future in pending: future.cancel()
+
+
+def before_deadline(results:Iterable, state:ScanState) -> Iterator:
+    """
+    Pass the results of a hashing stage along until a file could not
+    be finished before the deadline. What was in progress is dropped.
+    """
+    try:
+        yield from results
+    except fname.OutOfTime as e:
+        state.out_of_time = True
+
+
+def edge_hash_groups(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        state:ScanState,
+        blocks:int=1,
+        workers:int=1,
+        deadline:float=None,
+        edge_block:int=None,
+        bufsize:int=None,
+        cold_age:float=None) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    Split each group by the hash of the first blocks of the files.
+    If the edges differ, we will not need to hash the whole file,
+    and if they do not, the full hash carries on from where this
+    one stopped.
+
+    deadline -- a time.time() at which to stop, even in the middle of
+        a file. The groups that are not finished are dropped, and
+        state.out_of_time is set.
+    edge_block, bufsize, cold_age -- how to read the files, usually 
+        from an iotune.IOPlan; see Fname.edge_hash. None means the
+        defaults in Fname.
+    """
+    def hash_them(group:Tuple[int, List[fname.Fname]]) -> tuple:
+        size, candidates = group
+        before = sum(f._hashed_to for f in candidates)
+        hashed = [(f.edge_hash(blocks, deadline, edge_block, bufsize, cold_age), f) 
+            for f in candidates]
+        return size, hashed, sum(f._hashed_to for f in candidates) - before
+
+    # The counts are kept here, in the caller's thread, rather than 
+    # by the readers.
+    for size, hashed, n in before_deadline(in_parallel(hash_them, groups, workers), state):
+        state.groups_examined += 1
+        state.files_hashed += len(hashed)
+        state.bytes_hashed += max(n, 0)
+        temp = collections.defaultdict(list)
+        for k, f in hashed:
+            if k is None:
+                state.unreadable_files += 1
+                f.forget()
+            else:
+                temp[k].append(f)
+
+        for v in temp.values():
+            if len(v) == 1:
+                state.edge_detections += 1
+                v[0].forget()
+            else:
+                yield size, v
+
+
+def full_hash_groups(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        state:ScanState,
+        workers:int=1,
+        deadline:float=None,
+        bufsize:int=None,
+        cold_age:float=None) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    Split each group by the hash of the entire contents. The deadline
+    and the way of reading are as for edge_hash_groups.
+    """
+    def hash_them(group:Tuple[int, List[fname.Fname]]) -> tuple:
+        size, candidates = group
+        before = sum(f._hashed_to for f in candidates)
+        hashed = [(f.full_hash(deadline, bufsize, cold_age), f) for f in candidates]
+        return size, hashed, sum(f._hashed_to for f in candidates) - before
+
+    for size, hashed, n in before_deadline(in_parallel(hash_them, groups, workers), state):
+        state.bytes_hashed += max(n, 0)
+        temp = collections.defaultdict(list)
+        for k, f in hashed:
+            if k is None:
+                state.unreadable_files += 1
+                f.forget()
+            else:
+                temp[k].append(f)
+
+        for v in temp.values():
+            if len(v) == 1:
+                state.hash_detections += 1
+            else:
+                yield size, v
+
+
+def confirmed(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        state:ScanState) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    The last stage before a sink; it only counts what goes by.
+    """
+    for size, files in groups:
+        state.confirmed_groups += 1
+        yield size, files
+
+
+@functools.lru_cache(maxsize=None)
+def owner_name(uid:int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError as e:
+        return str(uid)
+
+
+def top_level(path:str, tops:Iterable[str]) -> str:
+    """
+    returns: -- the directory just below whichever of tops holds path,
+        e.g., /scratch/alice for /scratch/alice/run_0001/x.dat and a top
+        of /scratch. Files directly in a top count as the top itself.
+    """
+    for top in sorted(tops, key=len, reverse=True):
+        prefix = top.rstrip(os.sep) + os.sep
+        if path.startswith(prefix):
+            rest = path[len(prefix):]
+            if os.sep not in rest: return top
+            return prefix + rest.split(os.sep, 1)[0]
+    return os.path.dirname(path)
+
+
+def account(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        state:ScanState,
+        tops:Iterable[str]) -> Iterator[Tuple[int, List[fname.Fname]]]:
+    """
+    Add up the duplicated files and bytes by owner and by top level 
+    directory as the groups go by. The oldest file in each group is
+    taken to be the original, and the others are charged to their
+    owners and directories. The bytes are the ones allocated to the
+    files, as for reclaim.reclaim(), so the holes in sparse files are
+    not counted.
+    """
+    tops = [ expandall(_) for _ in tops ]
+    for size, files in groups:
+        for f in sorted(files, key=lambda f: f.DoB)[1:]:
+            uid = f.owner[0]
+            d = top_level(str(f), tops)
+            state.files_by_owner[uid] += 1
+            state.bytes_by_owner[uid] += f.allocated
+            state.files_by_dir[d] += 1
+            state.bytes_by_dir[d] += f.allocated
+        yield size, files
+
+
+def owner_rows(state:ScanState, units:str='B') -> Iterator[tuple]:
+    """
+    One row per owner, in the form of (owner, uid, files, dupbytes),
+    the biggest first.
+    """
+    for uid, n in state.bytes_by_owner.most_common():
+        yield owner_name(uid), uid, state.files_by_owner[uid], byte_scale(n, units)
+
+
+def dir_rows(state:ScanState, units:str='B') -> Iterator[tuple]:
+    """
+    One row per top level directory, in the form of (directory, files, 
+    dupbytes), the biggest first.
+    """
+    for d, n in state.bytes_by_dir.most_common():
+        yield d, state.files_by_dir[d], byte_scale(n, units)
+
+
+def report_rows(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        units:str='B') -> Iterator[tuple]:
+    """
+    One row per duplicated file, in the form of (hogsize, hogname, date,
+    owner).
+
+    Note: the str(f) is for clarity. When passing the Fname object to
+    pandas, pandas cannot makes sense of it, and its default
+    behavior is to invoke the object's str representation, which
+    Python guarantees us is available.
+    """
+    for hogsize, files in groups:
+        for f in files:
+            yield (byte_scale(hogsize, units),
+                str(f),
+                datetime.date.fromtimestamp(int(f.DoB)),
+                owner_name(f.owner[0]))
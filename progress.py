@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+How far along a scan is, written every so often by a thread of its
+own. The stages only count things in the ScanState, which costs
+them nothing, and the reporter looks at the counts when it wakes up:
+
+       r = Reporter(state, 10, log=print)
+       r.start()
+       ... run the stages ...
+       r.stop()
+
+While the files are being stat-ed, it reports how many have been
+seen and how fast; once hashing starts, how many files and bytes
+have been hashed, how fast, how many size groups are left, and
+about when they will be done.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import collections
+import datetime
+import threading
+import time
+
+import pipeline
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+MiB = 1<<20
+
+
+Sample = collections.namedtuple('Sample',
+    ('t', 'files_seen', 'files_hashed', 'bytes_hashed', 'groups_examined'))
+
+
+class Reporter(threading.Thread):
+    """
+    A daemon thread, so that it never keeps the program from ending.
+    An interval of 0 (or less) means that nothing is reported, and
+    the thread is never started.
+    """
+
+    def __init__(self, state:pipeline.ScanState, interval:float=10, *,
+            log:Callable[[str], None]=print):
+        super().__init__(name='progress', daemon=True)
+        self.state = state
+        self.interval = interval
+        self.log = log
+        self.halt = threading.Event()
+        self.hashing_since = None
+
+
+    def sample(self) -> Sample:
+        s = self.state
+        return Sample(time.monotonic(), s.files_seen, s.files_hashed,
+            s.bytes_hashed, s.groups_examined)
+
+
+    def line(self, last:Sample, now:Sample) -> str:
+        """
+        returns: -- what has happened since the last sample.
+        """
+        dt = (now.t - last.t) or 1
+        if not now.groups_examined:
+            return (f"{now.files_seen} files stat-ed, "
+                f"{round((now.files_seen - last.files_seen)/dt)} per second.")
+
+        if self.hashing_since is None: self.hashing_since = last
+        start = self.hashing_since
+        files_left = max(self.state.size_candidates - now.files_hashed, 0)
+        rate = (now.files_hashed - start.files_hashed) / ((now.t - start.t) or 1)
+        eta = datetime.timedelta(seconds=round(files_left / rate)) if rate else 'unknown'
+
+        return (f"{now.files_hashed} of {self.state.size_candidates} files hashed, "
+            f"{round((now.files_hashed - last.files_hashed)/dt)} files and "
+            f"{round((now.bytes_hashed - last.bytes_hashed)/dt/MiB, 1)} MiB per second; "
+            f"{self.state.size_groups - now.groups_examined} size groups to go, ETA {eta}.")
+
+
+    def run(self) -> None:
+        last = self.sample()
+        while not self.halt.wait(self.interval):
+            now = self.sample()
+            self.log(self.line(last, now))
+            last = now
+
+
+    def start(self) -> None:
+        if self.interval > 0: super().start()
+
+
+    def stop(self) -> None:
+        self.halt.set()
+        if self.is_alive(): self.join()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+Get the space back. For each group of identical files, one file is
+kept, and the others are replaced with either a hard link to it or
+a reflink (a copy that shares the kept file's blocks, on file systems
+like XFS and Btrfs that can do that).
+
+Nothing is replaced unless
+
+    1. every file in the group has the same full hash,
+    2. the file has not changed since it was stat-ed, and
+    3. we can get an exclusive lock on it.
+
+With dry_run, nothing is touched and no file is read, although the
+files are stat-ed again to see which of them would be skipped. The
+result says how many bytes would be freed, and how many bytes would still
+have to be read to verify the groups that only have edge hashes.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import collections
+import errno
+import fcntl
+
+import fname
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+###
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+###
+FICLONE = 0x40049409
+
+methods = ('hardlink', 'reflink')
+
+
+class ReclaimResult:
+    """
+    What happened, or with dry_run, what would have.
+    """
+
+    def __init__(self, method:str, dry_run:bool):
+        self.method = method
+        self.dry_run = dry_run
+        self.groups = 0
+        self.replaced = 0
+        self.freed = 0
+        self.to_verify = 0
+        self.skipped = collections.Counter()
+
+
+    def as_dict(self) -> dict:
+        return {'method':self.method,
+            'dry_run':self.dry_run,
+            'groups':self.groups,
+            'replaced':self.replaced,
+            'freed':self.freed,
+            'to_verify':self.to_verify,
+            'skipped':dict(self.skipped)}
+
+
+def unchanged(f:fname.Fname) -> Optional[os.stat_result]:
+    """
+    returns: -- a fresh stat of the file if it is still the file that
+        was hashed, otherwise None.
+    """
+    try:
+        st = os.stat(str(f), follow_symlinks=False)
+    except OSError as e:
+        return None
+
+    if (st.st_ino, st.st_dev, st.st_size, st.st_mtime) != (f._inode, f._dev, f._len, f._DoB):
+        return None
+    return st
+
+
+def _temp_name(target:str) -> str:
+    d, name = os.path.split(target)
+    return os.path.join(d, f".{name}.funiq-{os.getpid()}")
+
+
+def _hardlink(keeper:str, target:str) -> None:
+    tmp = _temp_name(target)
+    os.link(keeper, tmp)
+    try:
+        os.replace(tmp, target)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _reflink(keeper:str, target:str, st:os.stat_result) -> None:
+    """
+    Make a clone of the keeper with the target's owner, mode, and times,
+    and put it in the target's place.
+    """
+    tmp = _temp_name(target)
+    try:
+        with open(keeper, 'rb') as src, open(tmp, 'xb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.fchown(dst.fileno(), st.st_uid, st.st_gid)
+            os.fchmod(dst.fileno(), st.st_mode & 0o7777)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, target)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError as e:
+            pass
+        raise
+
+
+def verified(files:List[fname.Fname], result:ReclaimResult) -> List[List[fname.Fname]]:
+    """
+    Split a group by full hash. Digests that are already known are
+    used; with dry_run, the ones that are not known are not calculated,
+    and the group is taken as it is.
+    """
+    if result.dry_run and not all(f._content_hash for f in files):
+        result.to_verify += sum(len(f) - f._hashed_to for f in files if not f._content_hash)
+        return [files]
+
+    by_hash = collections.defaultdict(list)
+    for f in files:
+        digest = f.hash
+        if digest is None:
+            result.skipped['unreadable'] += 1
+        else:
+            by_hash[digest].append(f)
+    return [ v for v in by_hash.values() if len(v) > 1 ]
+
+
+def reclaim(groups:Iterable[Tuple[int, List[fname.Fname]]],
+        method:str='hardlink',
+        dry_run:bool=False,
+        log:Callable[[str], None]=None) -> ReclaimResult:
+    """
+    Replace all but one of each group of identical files with a link
+    to the one that is kept. The oldest file is kept. Hard links are
+    only made between files on the same device with the same owner,
+    group, and mode, because a hard link makes them one file.
+    """
+    if method not in methods:
+        raise ValueError(f"Unknown method {method}.")
+    log = log if log is not None else (lambda s: None)
+    result = ReclaimResult(method, dry_run)
+
+    for size, files in groups:
+        for same in verified(files, result):
+            result.groups += 1
+            keeper, *others = sorted(same, key=lambda f: f.DoB)
+            keeper_st = unchanged(keeper)
+            if keeper_st is None:
+                result.skipped['changed'] += len(others)
+                continue
+
+            for f in others:
+                if method == 'hardlink':
+                    if f._dev != keeper._dev:
+                        result.skipped['device'] += 1
+                        continue
+                    if f._inode == keeper._inode:
+                        result.skipped['linked'] += 1
+                        continue
+
+                if (st := unchanged(f)) is None:
+                    result.skipped['changed'] += 1
+                    continue
+
+                if method == 'hardlink' and ( (st.st_uid, st.st_gid, st.st_mode) !=
+                        (keeper_st.st_uid, keeper_st.st_gid, keeper_st.st_mode) ):
+                    result.skipped['owner'] += 1
+                    continue
+
+                # Only what is allocated comes back; the holes in a 
+                # sparse file were never taking up any room.
+                if dry_run:
+                    result.replaced += 1
+                    result.freed += f.allocated
+                    continue
+
+                # If someone else has it open with a lock, leave it be.
+                if not f.lock():
+                    result.skipped['busy'] += 1
+                    continue
+
+                try:
+                    if method == 'hardlink':
+                        _hardlink(str(keeper), str(f))
+                    else:
+                        _reflink(str(keeper), str(f), st)
+
+                except OSError as e:
+                    if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                        result.skipped['unsupported'] += 1
+                    else:
+                        result.skipped['error'] += 1
+                        log(f"Could not replace {f}: {e}")
+                    continue
+
+                else:
+                    result.replaced += 1
+                    result.freed += f.allocated
+
+                finally:
+                    f.unlock()
+
+    return result
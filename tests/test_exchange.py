@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Exports of two directories, as if from two hosts, are joined into
+the groups of files that are on both.
+"""
+
+import collections
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import exchange
+import fname
+
+
+def by_size(top) -> dict:
+    """
+    returns: -- the files under top, by size, as ScanState.by_size.
+    """
+    files = collections.defaultdict(list)
+    for p in sorted(top.iterdir()):
+        f = fname.Fname(str(p))
+        files[len(f)].append(f)
+    return files
+
+
+@pytest.fixture
+def hosts(tmp_path):
+    """
+    returns: -- two directories. Both have shared.dat, and each has a
+        file of the same size that the other does not. Only the first
+        has a pair of copies, which are on one host and so are not
+        joined.
+    """
+    shared = os.urandom(20000)
+    a, b = tmp_path / 'a', tmp_path / 'b'
+    a.mkdir()
+    b.mkdir()
+    (a / 'shared.dat').write_bytes(shared)
+    (b / 'shared.dat').write_bytes(shared)
+    (a / 'mine.dat').write_bytes(os.urandom(20000))
+    (b / 'yours.dat').write_bytes(os.urandom(20000))
+    local = os.urandom(30000)
+    (a / 'copy1.dat').write_bytes(local)
+    (a / 'copy2.dat').write_bytes(local)
+    return a, b
+
+
+@pytest.mark.parametrize('full', (True, False))
+def test_join_finds_only_files_on_both_hosts(tmp_path, hosts, full):
+    paths = []
+    for top, host in zip(hosts, ('hostA', 'hostB')):
+        path = str(tmp_path / f"{host}.fqx")
+        exchange.export(by_size(top), path, host=host, full=full)
+        assert exchange.about(path)['full'] == full
+        paths.append(path)
+
+    groups = list(exchange.join(paths))
+    assert len(groups) == 1
+    size, records = groups[0]
+    assert size == 20000
+    assert sorted(r.host for r in records) == ['hostA', 'hostB']
+    assert {os.path.basename(r.path) for r in records} == {'shared.dat'}
+
+    # Within one host, the copies are found as well.
+    within = list(exchange.join(paths, within=True))
+    assert len(within) == 2
+
+
+def test_full_and_edge_exports_cannot_be_joined(tmp_path, hosts):
+    paths = []
+    for top, host, full in zip(hosts, ('hostA', 'hostB'), (True, False)):
+        path = str(tmp_path / f"{host}.fqx")
+        exchange.export(by_size(top), path, host=host, full=full)
+        paths.append(path)
+
+    with pytest.raises(ValueError):
+        list(exchange.join(paths))
+
+
+def test_parquet_export(tmp_path, hosts):
+    pytest.importorskip('pyarrow')
+    paths = []
+    for top, host in zip(hosts, ('hostA', 'hostB')):
+        path = str(tmp_path / f"{host}.parquet")
+        exchange.export(by_size(top), path, host=host)
+        paths.append(path)
+
+    assert len(list(exchange.join(paths))) == 1
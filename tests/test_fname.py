@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""
+Digests that are already known are shared, whichever of the files
+was hashed first, and however it was hashed.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import fname
+
+
+@pytest.fixture
+def twins(tmp_path):
+    """
+    returns: -- two identical files, much longer than an edge.
+    """
+    data = os.urandom(100000)
+    paths = [ tmp_path / 'e1', tmp_path / 'e2' ]
+    for p in paths: p.write_bytes(data)
+    return [ str(p) for p in paths ]
+
+
+@pytest.mark.parametrize('first', (0, 1))
+def test_full_hash_then_compare(twins, first):
+    files = [ fname.Fname(p) for p in twins ]
+    assert files[first].hash is not None
+    assert files[0] @ files[1]
+    assert files[1] @ files[0]
+
+
+@pytest.mark.parametrize('first', (0, 1))
+def test_full_hash_then_partition(twins, first):
+    files = [ fname.Fname(p) for p in twins ]
+    assert files[first].hash is not None
+    classes = fname.Fname.partition_identical(files)
+    assert [ sorted(str(f) for f in c) for c in classes ] == [ sorted(twins) ]
+
+
+@pytest.mark.parametrize('first', (0, 1))
+def test_edge_of_hashed_file(twins, first):
+    files = [ fname.Fname(p) for p in twins ]
+    files[first].hash
+    assert files[0].edge_hash() == files[1].edge_hash()
+    assert files[0].edge_hash() != files[0].hash
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+Files that are not what they were when they were stat-ed, or that
+could not share an inode with the file that is kept, are left alone,
+whether or not it is a dry run.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import fname
+import reclaim
+
+
+def copies(tmp_path, n:int, data:bytes=b'funiq' * 1000) -> list:
+    """
+    returns: -- n identical files, oldest first, so that the first
+        one is kept.
+    """
+    files = []
+    for i in range(n):
+        p = tmp_path / f"copy{i}"
+        p.write_bytes(data)
+        os.utime(p, (1000000000 + i, 1000000000 + i))
+        os.chmod(p, 0o644)
+        files.append(str(p))
+    return files
+
+
+def group(paths:list) -> list:
+    fs = [ fname.Fname(p) for p in paths ]
+    return [ (len(fs[0]), fs) ]
+
+
+@pytest.mark.parametrize('dry_run', (False, True))
+def test_identical_copies_are_linked(tmp_path, dry_run):
+    paths = copies(tmp_path, 2)
+    result = reclaim.reclaim(group(paths), 'hardlink', dry_run)
+
+    assert result.replaced == 1
+    assert result.freed == fname.Fname(paths[1]).allocated
+    assert (os.stat(paths[0]).st_ino == os.stat(paths[1]).st_ino) == (not dry_run)
+
+
+@pytest.mark.parametrize('dry_run', (False, True))
+def test_different_mode_is_left_alone(tmp_path, dry_run):
+    paths = copies(tmp_path, 2)
+    os.chmod(paths[1], 0o600)
+    result = reclaim.reclaim(group(paths), 'hardlink', dry_run)
+
+    assert result.replaced == 0
+    assert result.freed == 0
+    assert result.skipped['owner'] == 1
+    assert os.stat(paths[0]).st_ino != os.stat(paths[1]).st_ino
+
+
+@pytest.mark.parametrize('dry_run', (False, True))
+def test_changed_file_is_left_alone(tmp_path, dry_run):
+    paths = copies(tmp_path, 2)
+    groups = group(paths)
+    for f in groups[0][1]: f.hash
+
+    # Same length, different contents, and a new mtime.
+    with open(paths[1], 'r+b') as f:
+        f.write(b'FUNIQ')
+    result = reclaim.reclaim(groups, 'hardlink', dry_run)
+
+    assert result.replaced == 0
+    assert result.skipped['changed'] == 1
+    assert os.stat(paths[0]).st_ino != os.stat(paths[1]).st_ino
+    with open(paths[1], 'rb') as f:
+        assert f.read(5) == b'FUNIQ'
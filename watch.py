@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+
+"""
+A live index of duplicate files. One scan fills the index, and
+after that inotify tells us what changed, so only the files that
+were created, written, moved or deleted are looked at again. The
+current duplicate groups are served over a Unix socket:
+
+       w = Watcher('/scratch', small_file=4097)
+       w.serve('/run/funiq.sock')
+
+and from anywhere else on the host,
+
+       python watch.py /run/funiq.sock groups
+
+Only inotify is used. Recursive watching is one watch per
+directory on a single inotify descriptor, so the number of
+directories is limited by /proc/sys/fs/inotify/max_user_watches.
+"""
+
+import os
+import sys
+
+import typing
+from   typing import *
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import json
+import selectors
+import socket
+import stat
+import struct
+import time
+
+import fname
+import pipeline
+
+# Credits
+__author__ =        'George Flanagin'
+__copyright__ =     'Copyright 2021 George Flanagin'
+__credits__ =       'None. This idea has been around forever.'
+__version__ =       '2.0'
+__maintainer__ =    'George Flanagin'
+__email__ =         'me+funiq@georgeflanagin.com'
+__status__ =        'continual development.'
+__license__ =       'MIT'
+
+###
+# From <sys/inotify.h>
+###
+IN_MODIFY       = 0x00000002
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = os.O_NONBLOCK
+IN_CLOEXEC      = os.O_CLOEXEC
+
+event_header = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Just enough of inotify(7), by way of ctypes, to watch a tree.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm = libc.inotify_rm_watch
+        self._rm.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+
+    def add_watch(self, path:str, mask:int) -> int:
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+
+    def rm_watch(self, wd:int) -> None:
+        self._rm(self.fd, wd)
+
+
+    def read(self) -> Iterator[Tuple[int, int, int, str]]:
+        """
+        Yield (wd, mask, cookie, name) for every event that is waiting.
+        """
+        while True:
+            try:
+                buf = os.read(self.fd, 1<<16)
+            except BlockingIOError as e:
+                return
+
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, n = event_header.unpack_from(buf, i)
+                i += event_header.size
+                name = os.fsdecode(buf[i:i+n].rstrip(b'\0'))
+                i += n
+                yield wd, mask, cookie, name
+
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class DuplicateIndex:
+    """
+    Every qualified file, by size. The duplicate groups for a size
+    are only worked out again after something of that size has
+    come or gone, and the Fname objects keep their digests, so only
+    the new files are read.
+    """
+
+    def __init__(self, blocks:int=1, full:bool=False):
+        self.blocks = blocks
+        self.full = full
+        self.state = pipeline.ScanState()
+        self.by_size = collections.defaultdict(dict)
+        self.by_path = {}
+        self.by_dir = collections.defaultdict(set)
+        self.groups_by_size = {}
+        self.dirty = set()
+
+
+    def __len__(self) -> int:
+        return len(self.by_path)
+
+
+    def add(self, f:fname.Fname) -> None:
+        path = str(f)
+        self.discard(path)
+        size = len(f)
+        self.by_size[size][path] = f
+        self.by_path[path] = size
+        self.by_dir[os.path.dirname(path)].add(path)
+        self.dirty.add(size)
+
+
+    def discard(self, path:str) -> None:
+        size = self.by_path.pop(path, None)
+        if size is None: return
+
+        members = self.by_size[size]
+        members.pop(path, None)
+        if not members: del self.by_size[size]
+        self.dirty.add(size)
+
+        d = os.path.dirname(path)
+        here = self.by_dir.get(d)
+        if here is not None:
+            here.discard(path)
+            if not here: del self.by_dir[d]
+
+
+    def discard_dirs(self, dirs:Iterable[str]) -> None:
+        """
+        Forget the files in these directories (but not in the ones 
+        below them, which must be named, too).
+        """
+        for d in dirs:
+            for path in list(self.by_dir.get(d, ())):
+                self.discard(path)
+
+
+    def refresh(self) -> None:
+        for size in self.dirty:
+            members = self.by_size.get(size, {})
+            if len(members) < 2:
+                self.groups_by_size.pop(size, None)
+                continue
+
+            groups = pipeline.edge_hash_groups([(size, list(members.values()))],
+                self.state, self.blocks)
+            if self.full:
+                groups = pipeline.full_hash_groups(groups, self.state)
+            self.groups_by_size[size] = [v for _, v in groups]
+
+        self.dirty.clear()
+
+
+    def groups(self) -> List[Tuple[int, List[fname.Fname]]]:
+        """
+        The current duplicate groups, biggest files first.
+        """
+        self.refresh()
+        return [ (size, v)
+            for size in sorted(self.groups_by_size, reverse=True)
+                for v in self.groups_by_size[size] ]
+
+
+class Watcher:
+    """
+    Keep a DuplicateIndex of everything under top up to date.
+
+    The keyword arguments are the same as those of pipeline.scan and
+    pipeline.qualify, except that young_file is in days, and is 
+    measured from the time each file is looked at rather than from 
+    the start.
+    """
+
+    MASK = ( IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR )
+
+    def __init__(self, top:str, *,
+            include_hidden:bool=False,
+            exclude:Iterable[str]=(),
+            follow_links:bool=False,
+            one_file_system:bool=False,
+            small_file:int=0,
+            young_file:int=0,
+            skip_uids:Container[int]=(),
+            blocks:int=1,
+            full:bool=False,
+            settle:float=0.5,
+            log:Callable[[str], None]=None):
+
+        self.top = pipeline.expandall(top)
+        self.include_hidden = include_hidden
+        self.exclude = tuple(exclude)
+        self.follow_links = follow_links
+        self.one_file_system = one_file_system
+        self.small_file = small_file
+        self.young_file = young_file
+        self.skip_uids = tuple(skip_uids)
+        self.blocks = blocks
+        self.full = full
+        self.settle = settle
+        self.log = log if log is not None else (lambda s: None)
+
+        self.inotify = None
+        self.index = None
+        self.wd_to_dir = {}
+        self.dir_to_wd = {}
+        self.subdirs = collections.defaultdict(set)
+        self.pending = set()
+        self.out_of_watches = False
+
+
+    def _criteria(self) -> dict:
+        return dict(exclude=self.exclude,
+            follow_links=self.follow_links,
+            small_file=self.small_file,
+            skip_uids=self.skip_uids,
+            youngest_file=time.time() - self.young_file*86400 if self.young_file else None)
+
+
+    def _hidden(self, path:str) -> bool:
+        """
+        True if the file or directory is hidden, or is in a hidden
+        directory, and those are not wanted. The test is the same as
+        the one in pipeline.scan.
+        """
+        return not self.include_hidden and '/.' in path
+
+
+    def _pruned(self, d:str) -> bool:
+        """
+        True if nothing in the directory could ever be qualified.
+        """
+        if self._hidden(d): return True
+        return any(_ in d + os.sep for _ in self.exclude)
+
+
+    def _watch(self, d:str) -> bool:
+        try:
+            wd = self.inotify.add_watch(d, Watcher.MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC and not self.out_of_watches:
+                self.out_of_watches = True
+                self.log("Out of inotify watches. Raise fs.inotify.max_user_watches.")
+            return False
+
+        self.wd_to_dir[wd] = d
+        self.dir_to_wd[d] = wd
+        if d != self.top: self.subdirs[os.path.dirname(d)].add(d)
+        return True
+
+
+    def _forget_dir(self, d:str) -> None:
+        """
+        Take a directory that is no longer watched out of the tree.
+        """
+        parent = os.path.dirname(d)
+        siblings = self.subdirs.get(parent)
+        if siblings is not None:
+            siblings.discard(d)
+            if not siblings: del self.subdirs[parent]
+
+
+    def _unwatch_tree(self, top:str) -> List[str]:
+        """
+        Stop watching top and everything below it. Only that part
+        of the tree is looked at.
+
+        returns: -- the directories that were being watched.
+        """
+        found = []
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            stack.extend(self.subdirs.pop(d, ()))
+            wd = self.dir_to_wd.pop(d, None)
+            if wd is None: continue
+            self.wd_to_dir.pop(wd, None)
+            self.inotify.rm_watch(wd)
+            found.append(d)
+        self._forget_dir(top)
+        return found
+
+
+    def _walk(self, top:str) -> Iterator[os.DirEntry]:
+        """
+        Watch every directory under top, and yield the files in it.
+        A directory is watched before it is read, so that nothing
+        created in between can be missed.
+        """
+        top_dev = os.stat(self.top).st_dev
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            if self._pruned(d): continue
+            try:
+                if self.one_file_system and os.stat(d).st_dev != top_dev: continue
+            except OSError as e:
+                continue
+            if not self._watch(d): continue
+            try:
+                with os.scandir(d) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif not self._hidden(entry.path):
+                            yield entry
+            except OSError as e:
+                continue
+
+
+    def rebuild(self) -> None:
+        """
+        Start over: new watches, and one scan into a new index. The
+        inotify descriptor is kept, so that whoever is waiting on it
+        goes on getting events; the old watches are removed first,
+        so that the new ones are given new numbers.
+        """
+        if self.inotify is None: self.inotify = Inotify()
+        for wd in self.wd_to_dir: self.inotify.rm_watch(wd)
+        self.wd_to_dir.clear()
+        self.dir_to_wd.clear()
+        self.subdirs.clear()
+        self.pending.clear()
+
+        self.index = DuplicateIndex(self.blocks, self.full)
+        files = pipeline.qualify(self._walk(self.top), self.index.state, **self._criteria())
+        for _ in pipeline.group_by_size(files, self.index.state): pass
+
+        for members in self.index.state.by_size.values():
+            for f in members: self.index.add(f)
+        self.index.state.by_size.clear()
+        self.index.refresh()
+        self.log(f"Watching {len(self.dir_to_wd)} directories and {len(self.index)} files.")
+
+
+    def _apply(self) -> None:
+        """
+        Look again at each file that something happened to.
+        """
+        state = self.index.state
+        criteria = self._criteria()
+        for path in self.pending:
+            f = next(pipeline.qualify([path], state, **criteria), None)
+            if f is None or not f or f._nlink > 1:
+                self.index.discard(path)
+            else:
+                self.index.add(f)
+        self.pending.clear()
+
+
+    def _events(self) -> bool:
+        """
+        Read what inotify has for us. Returns False if the tree
+        itself is gone.
+        """
+        for wd, mask, cookie, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.log("inotify queue overflowed; rescanning.")
+                self.rebuild()
+                return True
+
+            if mask & IN_IGNORED:
+                d = self.wd_to_dir.pop(wd, None)
+                if d is not None and self.dir_to_wd.get(d) == wd: 
+                    del self.dir_to_wd[d]
+                    self._forget_dir(d)
+                continue
+
+            d = self.wd_to_dir.get(wd)
+            if d is None: continue
+            if mask & IN_DELETE_SELF:
+                if d == self.top: return False
+                continue
+
+            path = os.path.join(d, name)
+            if self._hidden(path): continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.pending.update(_.path for _ in self._walk(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.index.discard_dirs(self._unwatch_tree(path))
+            else:
+                self.pending.add(path)
+
+        return True
+
+
+    def _answer(self, conn:socket.socket) -> None:
+        """
+        One request per connection: a line with 'groups' or 'stats'.
+        The reply is a JSON document.
+        """
+        with conn:
+            conn.settimeout(1.0)
+            try:
+                request = conn.makefile('r').readline().strip() or 'groups'
+            except OSError as e:
+                return
+
+            self._apply()
+            if request == 'groups':
+                reply = [ {'size':size, 'files':[str(f) for f in v]}
+                    for size, v in self.index.groups() ]
+            elif request == 'stats':
+                groups = self.index.groups()
+                reply = {'top':self.top,
+                    'directories':len(self.dir_to_wd),
+                    'files':len(self.index),
+                    'groups':len(groups),
+                    'duplicates':sum(len(v) for _, v in groups),
+                    'reclaimable':sum(size*(len(v)-1) for size, v in groups)}
+            else:
+                reply = {'error':f"unknown request {request}"}
+
+            try:
+                conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+            except OSError as e:
+                pass
+
+
+    def serve(self, sock_path:str) -> int:
+        """
+        Scan, and then answer questions until interrupted.
+        """
+        self.rebuild()
+
+        sock_path = pipeline.expandall(sock_path)
+        try:
+            if stat.S_ISSOCK(os.stat(sock_path).st_mode): os.unlink(sock_path)
+        except FileNotFoundError as e:
+            pass
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(sock_path)
+        os.chmod(sock_path, 0o600)
+        listener.listen()
+        self.log(f"Answering queries on {sock_path}")
+
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ, 'query')
+        selector.register(self.inotify.fd, selectors.EVENT_READ, 'inotify')
+
+        try:
+            while True:
+                # Changes usually come in bursts, so wait for the
+                # burst to end before looking at the files.
+                ready = selector.select(self.settle if self.pending else None)
+                if not ready:
+                    self._apply()
+                    continue
+
+                for key, _ in ready:
+                    if key.data == 'query':
+                        conn, _ = listener.accept()
+                        self._answer(conn)
+                    elif not self._events():
+                        self.log(f"{self.top} is gone.")
+                        return os.EX_OK
+
+        except KeyboardInterrupt as e:
+            return os.EX_OK
+
+        finally:
+            selector.close()
+            listener.close()
+            self.inotify.close()
+            try:
+                os.unlink(sock_path)
+            except OSError as e:
+                pass
+
+
+def query(sock_path:str, request:str='groups') -> Any:
+    """
+    Ask a running Watcher a question.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(pipeline.expandall(sock_path))
+        s.sendall(request.encode('utf-8') + b'\n')
+        return json.loads(s.makefile('r').read())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("You must provide the name of a funiq socket.")
+        exit(1)
+    print(json.dumps(query(*sys.argv[1:3]), indent=4))